@@ -0,0 +1,357 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+
+import tracing
+
+#### Setup
+
+# The bundle lives next to the Plot Data CSVs it is built from (see py/build_bundle.py).
+# Each published version is its own folder, and the CURRENT file names the one the app should serve.
+BUNDLE_ROOT = Path(os.environ.get('DODAPP_BUNDLE_DIR', Path(__file__).resolve().parent.parent / 'Clean Data' / 'Bundle'))
+
+# Remote CSVs on GitHub are only read when this is switched on explicitly
+REMOTE_URL = 'https://github.com/abdelkaderalia/DoDContractApp/raw/main/Clean%20Data/Plot%20Data/{}.csv'
+REMOTE_FALLBACK = os.environ.get('DODAPP_REMOTE_FALLBACK', '') == '1'
+
+# Tables published on GitHub. They predate agency partitions, so their breakdowns are DoD's
+REMOTE_AGENCY = '097'
+REMOTE_TABLES = ['award_type',
+                 'awarding_office_name',
+                 'awarding_office_name_count',
+                 'awarding_sub_agency_name',
+                 'awarding_sub_agency_name_count',
+                 'compare_agencies',
+                 'compare_all_spending',
+                 'contract_bundling',
+                 'data_coordinates',
+                 'dod_claimant_program_description',
+                 'naics_description',
+                 'primary_place_of_performance_state_code',
+                 'product_or_service_code_description',
+                 'recipient_name',
+                 'recipient_name_count',
+                 'solicitation_procedures',
+                 'type_of_contract_pricing']
+
+# Memory budget for loaded dataframes, shared by every session in the process
+CACHE_BYTES = int(os.environ.get('DODAPP_DATA_CACHE_MB', 256)) * 1024 * 1024
+
+# Load every table as soon as a bundle version is first seen, so no user pays for a cold load
+PREWARM = os.environ.get('DODAPP_PREWARM', '') == '1'
+
+# How often a running app checks the CURRENT pointer for a new bundle version, in seconds
+WATCH_SECONDS = float(os.environ.get('DODAPP_WATCH_SECONDS', 30))
+
+_lock = threading.RLock()
+_tables = {} # (version, name) -> memory-mapped pa.Table
+_frames = OrderedDict() # (version, name) -> (pd.DataFrame, bytes), least recently used first
+_nbytes = 0
+_dtypes = {} # (version, label domain) -> (dictionary as pa.Array, shared pd.CategoricalDtype)
+_current = {} # root -> (mtime of CURRENT, version)
+_listeners = []
+_warmers = {} # name -> function called with a version once its tables are prewarmed
+_watcher = None
+
+stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+#### Functions
+
+def current_version(root=None):
+    """
+    This function returns the version of the bundle that is currently published. The CURRENT file is only re-read
+    when it changes, and a change of version invalidates everything cached for older versions.
+    Input: root folder of the bundle (optional)
+    Output: version (string)
+    """
+    root = Path(root or BUNDLE_ROOT)
+    mtime = (root / 'CURRENT').stat().st_mtime_ns
+    seen = _current.get(root)
+    if seen is not None and seen[0] == mtime:
+        return seen[1]
+
+    version = (root / 'CURRENT').read_text().strip()
+    with _lock:
+        # Only the first thread to see a change invalidates and prewarms, with the watcher running next to sessions
+        if _current.get(root) != seen:
+            return _current[root][1]
+        _current[root] = (mtime, version)
+    if seen is not None and seen[1] != version:
+        invalidate(keep=version)
+    if PREWARM and (seen is None or seen[1] != version):
+        threading.Thread(target=prewarm, args=(version, root), daemon=True).start()
+    return version
+
+def read_manifest(version=None, root=None):
+    """
+    This function reads the manifest of a bundle version, which lists its tables and their row counts.
+    Input: version (optional, defaults to the current one), root folder (optional)
+    Output: manifest (dict)
+    """
+    root = Path(root or BUNDLE_ROOT)
+    version = version or current_version(root)
+    with open(root / version / 'manifest.json') as f:
+        return json.load(f)
+
+def open_table(name, version=None, root=None):
+    """
+    This function memory-maps one table of the bundle as an Arrow table. The file is mapped once per process,
+    so every session reads the same pages instead of holding its own copy.
+    Input: table name, version (optional), root folder (optional)
+    Output: pa.Table
+    """
+    root = Path(root or BUNDLE_ROOT)
+    version = version or current_version(root)
+    key = (version, name)
+    with _lock:
+        if key not in _tables:
+            path = root / version / f'{name}.arrow'
+            if not path.exists():
+                raise KeyError(f'{name} is not in data bundle {version}')
+            source = pa.memory_map(str(path), 'r')
+            _tables[key] = pa.ipc.open_file(source).read_all()
+        return _tables[key]
+
+def read_table(name, version=None, root=None):
+    """
+    This function returns one table of the bundle as a dataframe. Dataframes are shared by all sessions and kept
+    within the memory budget, least recently used first out, so callers should treat them as read-only.
+    Input: table name, version (optional), root folder (optional)
+    Output: pd.DataFrame
+    """
+    root = Path(root or BUNDLE_ROOT)
+    try:
+        version = version or current_version(root)
+    except FileNotFoundError:
+        if REMOTE_FALLBACK and remote_name(name):
+            return _fetch(name)
+        raise
+    key = (version, name)
+    with _lock:
+        if key in _frames:
+            _frames.move_to_end(key)
+            stats['hits'] += 1
+            tracing.count('data_cache.hit')
+            return _frames[key][0]
+        stats['misses'] += 1
+    tracing.count('data_cache.miss')
+
+    try:
+        table = open_table(name, version, root)
+    except KeyError:
+        if REMOTE_FALLBACK and remote_name(name):
+            return _fetch(name)
+        raise
+    with tracing.span('to_frame', table=name):
+        df = to_frame(table, version)
+    return _remember(key, df)
+
+def read_derived(name, build, nbytes, version=None, root=None):
+    """
+    This function returns an object built from bundle tables, like an agency's map bins or search index. It is built
+    once per version and cached with the tables, so it counts against the same memory budget and is evicted and
+    invalidated the same way.
+    Input: name, function building the object, function measuring its bytes, version (optional), root folder (optional)
+    Output: the object
+    """
+    version = version or current_version(root)
+    key = (version, name)
+    with _lock:
+        if key in _frames:
+            _frames.move_to_end(key)
+            stats['hits'] += 1
+            tracing.count('data_cache.hit')
+            return _frames[key][0]
+        stats['misses'] += 1
+    tracing.count('data_cache.miss')
+    with tracing.span('build', table=name):
+        obj = build()
+    return _remember(key, obj, nbytes(obj))
+
+def to_frame(table, version):
+    """
+    This function converts a bundle table to a dataframe. Dictionary encoded labels become categoricals that share
+    one set of categories per kind of label (see py/build_bundle.py), so each distinct name is held once per
+    process however many tables it appears in. Numbers keep the narrow types they were stored with.
+    Input: pa.Table, bundle version
+    Output: pd.DataFrame
+    """
+    columns = {}
+    for field, column in zip(table.schema, table.columns):
+        if not pa.types.is_dictionary(field.type):
+            columns[field.name] = column.to_pandas()
+            continue
+        column = column.combine_chunks()
+        domain = (field.metadata or {}).get(b'domain', field.name.encode()).decode()
+        with _lock:
+            shared = _dtypes.get((version, domain))
+            if shared is None or not shared[0].equals(column.dictionary):
+                dtype = pd.CategoricalDtype(pd.Index(column.dictionary.to_pylist()))
+                shared = _dtypes.setdefault((version, domain), (column.dictionary, dtype))
+                if not shared[0].equals(column.dictionary): # Not built with the shared dictionary, keep its own
+                    shared = (column.dictionary, dtype)
+        columns[field.name] = pd.Categorical.from_codes(column.indices.fill_null(-1).to_numpy(), dtype=shared[1])
+    return pd.DataFrame(columns)
+
+def frame_bytes(df):
+    """
+    This function measures the memory held by a dataframe, counting categorical columns by their codes only since
+    their categories are shared.
+    Input: pd.DataFrame
+    Output: bytes (int)
+    """
+    size = df.index.memory_usage(deep=True)
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            size += df[col].cat.codes.nbytes
+        else:
+            size += df[col].memory_usage(index=False, deep=True)
+    return int(size)
+
+def _remember(key, df, size=None):
+    """
+    This function adds a dataframe to the cache and evicts the least recently used ones over the memory budget.
+    Input: cache key, pd.DataFrame (or object built from tables), its size in bytes (optional for dataframes)
+    Output: the cached pd.DataFrame (an existing one if another session loaded it first)
+    """
+    global _nbytes
+    with _lock:
+        if key in _frames:
+            return _frames[key][0]
+        size = frame_bytes(df) if size is None else size
+        _frames[key] = (df, size)
+        _nbytes += size
+        while _nbytes > CACHE_BYTES and len(_frames) > 1:
+            _, (_, evicted) = _frames.popitem(last=False)
+            _nbytes -= evicted
+            stats['evictions'] += 1
+        return df
+
+def invalidate(keep=None):
+    """
+    This function drops cached tables, for example once a new bundle has been published.
+    Input: version to keep (optional, drops everything if not given)
+    Output: None
+    """
+    global _nbytes
+    with _lock:
+        for key in [k for k in _frames if k[0] != keep]:
+            _nbytes -= _frames.pop(key)[1]
+        for key in [k for k in _tables if k[0] != keep]:
+            del _tables[key]
+        for key in [k for k in _dtypes if k[0] != keep]:
+            del _dtypes[key]
+    for callback in _listeners:
+        callback(keep)
+
+def on_invalidate(callback):
+    """
+    This function registers a callback to run whenever cached tables are invalidated, so caches built on top of
+    the bundle can be dropped at the same time.
+    Input: function taking the version that is kept (or None)
+    Output: None
+    """
+    _listeners.append(callback)
+
+def on_prewarm(name, callback):
+    """
+    This function registers a callback to run once every table of a bundle version has been prewarmed, so caches
+    built on top of the bundle (like the figure cache) can be filled before any user asks. Registering the same
+    name again replaces its callback.
+    Input: name, function taking the version
+    Output: None
+    """
+    _warmers[name] = callback
+
+def prewarm(version=None, root=None):
+    """
+    This function loads every table of a bundle version into the cache, then runs the prewarm callbacks.
+    Input: version (optional), root folder (optional)
+    Output: number of tables loaded
+    """
+    manifest = read_manifest(version, root)
+    for name in manifest['tables']:
+        read_table(name, manifest['version'], root)
+    for callback in list(_warmers.values()):
+        callback(manifest['version'])
+    return len(manifest['tables'])
+
+def watch(interval=WATCH_SECONDS, root=None):
+    """
+    This function starts a background thread, once per process, that checks the CURRENT pointer right away and then
+    every interval seconds. A bundle version is then picked up, and prewarmed with DODAPP_PREWARM=1, as soon as it
+    is published instead of on the first read after it.
+    Input: seconds between checks, root folder (optional)
+    Output: None
+    """
+    global _watcher
+    with _lock:
+        if _watcher is not None:
+            return
+        _watcher = threading.Thread(target=_watch, args=(interval, root), daemon=True)
+        _watcher.start()
+
+def _watch(interval, root):
+    """
+    This function checks the CURRENT pointer forever, for the watcher thread.
+    Input: seconds between checks, root folder
+    Output: None
+    """
+    while True:
+        try:
+            current_version(root)
+        except FileNotFoundError: # Nothing published yet
+            pass
+        time.sleep(interval)
+
+def cache_info():
+    """
+    This function describes the current state of the table cache.
+    Input: None
+    Output: dict with the number of tables and bytes held, the bytes of each table and of the shared label
+            dictionaries, the budget, and hit/miss/eviction counts
+    """
+    with _lock:
+        by_table = {name: size for (_, name), (_, size) in _frames.items()}
+        shared = sum(int(dtype.categories.memory_usage(deep=True)) for _, dtype in _dtypes.values())
+        return {'tables': len(_frames), 'bytes': _nbytes, 'by_table': by_table, 'dictionary_bytes': shared,
+                'budget': CACHE_BYTES, **stats}
+
+def remote_name(name):
+    """
+    This function returns the name a bundle table has in the Plot Data on Github, where tables are not partitioned
+    by agency and only cover DoD.
+    Input: table name
+    Output: remote table name, None if the table is not published there
+    """
+    prefix = f'agency={REMOTE_AGENCY}/'
+    name = name[len(prefix):] if name.startswith(prefix) else name
+    return name if name in REMOTE_TABLES else None
+
+def _fetch(name):
+    """
+    This function downloads a table missing from the bundle once, keeping it in the cache within the memory budget
+    until a new bundle version is published.
+    Input: table name
+    Output: pd.DataFrame
+    """
+    key = ('remote', name)
+    with _lock:
+        if key in _frames:
+            _frames.move_to_end(key)
+            return _frames[key][0]
+    return _remember(key, read_remote(name))
+
+def read_remote(name):
+    """
+    This function downloads a Plot Data CSV from the Github repository for this project. It is only used as a fallback.
+    Input: table name
+    Output: pd.DataFrame
+    """
+    return pd.read_csv(REMOTE_URL.format(remote_name(name)))
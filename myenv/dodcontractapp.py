@@ -1,18 +1,12 @@
 import streamlit as st
 st.set_page_config(page_icon="heavy_dollar_sign",page_title="DoD Service Contract Spending Explorer",layout="wide") # Increase page width for app
-import pandas as pd
 import numpy as np
-import sys
-import requests
-import openpyxl
-import plotly as plt
-import plotly.express as px
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-import time
-import geopandas as gpd
-from mpl_toolkits.axes_grid1 import make_axes_locatable
-import mapclassify
+import databundle
+import mapbins
+import query
+import search
+import tracing
+from figcache import cached_figure
 
 #### Functions
 
@@ -30,31 +24,79 @@ def human_format(num):
     return '{}{}'.format('{:f}'.format(num).rstrip('0').rstrip('.'),
                          ['', 'K', 'M', 'B', 'T'][magnitude])
 
-@st.cache(show_spinner=False)
-def get_data(fname):
+# Every 3 significant digit number from 100 to 999 written with 1, 2 or 3 digits before the point, as human_format writes it
+_DIGITS = np.array([['{:f}'.format(d / 10 ** (2 - p)).rstrip('0').rstrip('.') for d in range(100, 1000)] for p in range(3)], dtype=object)
+_SUFFIXES = np.array(['', 'K', 'M', 'B', 'T'], dtype=object)
+
+def human_format_array(nums):
+    """
+    This function changes a whole column of numbers to the same SI format as human_format, without a Python call per
+    number. Numbers below 1, rounding ties and anything else that cannot be done in bulk go through human_format.
+    Input: nums (array-like)
+    Output: Formatted numbers (np.ndarray of strings)
     """
-    This function imports a file of longitudinal contract spending data from the Github repository for this project.
-    Input: file name
+    x = np.asarray(nums, dtype=float)
+    out = np.empty(x.shape, dtype=object)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        exp = np.floor(np.log10(np.abs(x)))
+        scaled = np.abs(x) / 10.0 ** (exp - 2) # 3 digits before the point
+        digits = np.round(scaled)
+        bulk = (np.isfinite(exp) & (exp >= 0) & (exp < 15) & (scaled >= 100) & (scaled < 1000)
+                & (np.abs(scaled - np.floor(scaled) - 0.5) > 1e-6))
+
+    # Rounding 999.5 and up gives 1000, which is 100 at the next power of ten
+    carry = bulk & (digits == 1000)
+    digits[carry], exp[carry] = 100, exp[carry] + 1
+    bulk &= exp < 15
+
+    e, d = exp[bulk].astype(int), digits[bulk].astype(int)
+    sign = np.where(x[bulk] < 0, '-', '').astype(object)
+    out[bulk] = sign + _DIGITS[e % 3, d - 100] + _SUFFIXES[e // 3]
+    out[~bulk] = [human_format(num) for num in x[~bulk]]
+    return out
+
+def get_data(fname, agency_name=None):
+    """
+    This function loads a table of longitudinal contract spending data from the local data bundle for this project.
+    The bundle is memory-mapped once per process and shared across sessions. Tables broken down for one agency are
+    read from that agency's partition only. Set DODAPP_REMOTE_FALLBACK=1 to download tables missing from the bundle
+    from the Github repository instead.
+    Input: file name, agency name (for tables partitioned by agency)
     Output: Dataframe of agencies their total spending (pd.Dataframe)
     """
-    url = f'https://github.com/abdelkaderalia/DoDContractApp/raw/main/Clean%20Data/Plot%20Data/{fname}.csv'
-    df = pd.read_csv(url)
-    return df
+    if agency_name is not None:
+        fname = f'agency={agency_code(agency_name)}/{fname}'
+    with tracing.span(f'get_data:{fname}'):
+        return databundle.read_table(fname)
+
+def agency_code(agency_name):
+    """
+    This function looks up the code of an agency, which names its partition of the data bundle and contract rows.
+    Input: agency name
+    Output: agency code (string)
+    """
+    df_codes = databundle.read_table('agencies')
+    return df_codes.loc[df_codes['agency']==agency_name, 'code'].iloc[0]
+
+def agency_label(agency_name):
+    """
+    This function shortens an agency name for headings, e.g. DoD for the Department of Defense.
+    Input: agency name
+    Output: short name (string)
+    """
+    return 'DoD' if agency_name == 'Department of Defense' else agency_name
 
-@st.cache
-#define function to get geo data
 def get_geo(df):
     """
-    This function combines the contract data with a shape file to create a map visualization.
-    Input: df of contract data, link to shapefile
+    This function adds state names to the contract data for the map visualization. It uses the prebuilt state
+    lookup table from the data bundle (see py/build_states.py), so no shapefile is read at request time.
+    Input: df of contract data with a State column
     Output: merged df
     """
-    geo = gpd.read_file('/vsicurl/https://github.com/abdelkaderalia/LIHEAPadminapp/raw/main/Data/tl_2021_us_state.shp')
-    #save shapefile to dataframe
-    geo = geo.to_crs("EPSG:4326")
-    geo = geo.rename(columns = {'STUSPS':'State'})
-
-    df_map = df.merge(geo,on='State',how='left')
+    with tracing.span('get_geo'):
+        states = get_data('states')
+        with tracing.span('merge'):
+            df_map = df.merge(states,on='State',how='left')
 
     return df_map
 
@@ -66,167 +108,94 @@ CB_color_cycle = ['#377eb8', '#ff7f00', '#4daf4a',
                   '#f781bf', '#a65628', '#984ea3',
                   '#999999', '#e41a1c', '#dede00']
 
+# Rerun only the fragment a widget belongs to; older Streamlit versions without fragments rerun the whole script
+fragment = getattr(st, 'fragment', None) or getattr(st, 'experimental_fragment', None) or (lambda func: func)
 
-#### App starts here
-if __name__ == "__main__":
-    #st.markdown('<h2 align="left">How much money does the federal government spend?</h2>', unsafe_allow_html=True) # Add app title
-    st.title('Department of Defense Service Contracting')
-    st.header('Opportunities for Category Management')
-    st.write('')
-
-    # Create tabs for the different visualizations
-    tab1, tab2, tab3, tab4, tab5 = st.tabs(['Understanding the Context', 'Comparing Other Agencies','Breaking Down Contracts Awarded','Categorizing Contract Types','Mapping Contracts Awarded'])
+# Map Tab 3 views to their data column and plural label
+sub_col_names = {'Awarding Subagency':['awarding_sub_agency_name','subagencies'],'Awarding Office':['awarding_office_name','offices'],'Contract Recipient':['recipient_name','recipients']}
 
-    ############## Tab 1
+# Map searchable columns to their labels
+search_labels = {'recipient_name':'Contract Recipient','awarding_office_name':'Awarding Office','product_or_service_code_description':'PSC'}
 
-    tab1.write('')
+# Create dictionary of category options
+categories = {'NAICS Code':'naics_description',
+'Product or Service Code (PSC)':'product_or_service_code_description',
+            'Contract Bundling':'contract_bundling'}
 
-    # Store links to external information
-    usasplink = 'https://www.usaspending.gov/search'
-    gaolink = 'https://www.gao.gov/products/hr-93-8'
-    gsalink = 'https://www.gsa.gov/buy-through-us/category-management#:~:text=Category%20Management%20is%20the%20practice,and%20effectiveness%20of%20acquisition%20activities'
+#### Figures
+# Each chart is fully determined by the arguments of its function, so the figures are cached across sessions
+# by selection and data bundle version (see figcache.py).
 
-    tab1.subheader('DoD leads in spending on service contracts, and some are concerned')
-    tab1.write(f'For at least the past decade, the Department of Defense (DoD) has spent more on contracts for services than any other federal agency every fiscal year. [DoD contracting has been on the General Accountability Office\'s (GAO) High-Risk List since 1992]({gaolink}), having been identified as an operation that is highly vulnerable to fraud, waste, abuse, and mismanagement.')
-
-    tab1.write('')
-
-    tab1.subheader('Category management is a possible solution')
-    tab1.write(f'[Category management]({gsalink}) is a strategy that helps organizations make smarter, more cost-effective purchases of goods and services by identifying core spending categories and making those acquisitions as a combined enterprise, allowing for the consolidation and reduction of contracts. In doing so, organizations can also reduce the amount of time and resources spent on procuring services and managing ongoing contracts.')
-
-    #cm = Image.open('https://github.com/abdelkaderalia/DoDContractApp/blob/main/Images/cm.png?raw=true')
-    #tab1.image(image,caption='Source: Acquisition.gov')
-
-    tab1.write('')
-
-    tab1.subheader("""Exploring trends in contract spending can demonstrate the potential for category management""")
-    tab1.write('Visualizing contract data can illuminate not only the magnitude of DoD’s contractual service spending but also highlight the potential benefit of a wider implementation of category management.')
-
-    tab1.write('')
-
-    tab1.subheader("""Data source and limitations""")
-
-    tab1.write(f'[USAspending]({usasplink}), a service run by the Department of the Treasury, publishes data on contracts as submitted by agencies to the Federal Procurement Data System.')
-
-    tab1.markdown("""This interactive web app features USAspending data for *prime award contracts for services only.* This does not include contracts to purchase physical products,
-    subaward contracts, or indefinite delivery vehicles (IDVs, a type of contract that allows the purchaser to buy an indefinite quantity of products or services over a fixed time period.)""")
-
-    ############# Tab 2
+@cached_figure
+def spending_fig(agency_name, agency_name2):
+    """
+    This function creates a line chart comparing service contract spending of DoD and another agency.
+    Input: agency name, agency name 2 (' ' if none is selected)
+    Output: Plotly figure
+    """
+    import plotly.express as px # Imported on first use to keep app start-up fast
 
-    # Import data to compare service contract spending across agencies
     df_agencies = get_data('compare_agencies')
-    # Create list of agencies to compare
     df_agencies = df_agencies.rename(columns={'agency':'Agency'})
 
-    # Import data to compare total spending across agencies
-    df_all = get_data('compare_all_spending')
-
-    agencies = df_agencies['Agency'].unique().tolist() # Convert agency names to list for dropdown menus
-    agencies.remove('Department of Defense')
-    agencies = sorted(agencies)
-    agencies.insert(0, ' ')
-
-    agency_name = 'Department of Defense'
-    tab2.subheader(f'How does the {agency_name} compare to other agencies?') # Add a subheader
-    tab2.markdown('<h6 align="left">View data on service contract funds that were newly awarded in the fiscal year</h6>', unsafe_allow_html=True) # Add a subheader
-    agency_name2 = tab2.selectbox("Compare with another one of the federal agencies that leads in service contracting:", agencies) # Store user selection for agency name 2
-
-    agency_describe = """DoD far outranks all other federal agencies in its service contract spending, which has been extremely proportional to its total spending over time.
-                    Not all other agencies see their contract spending trends mirrored in their total spending to the same degree."""
-
-    if agency_name2 == ' ': # If agency name 2 has not been selected
-
-        # Filter service contract data to just DoD
-        h = df_agencies[df_agencies['Agency']==agency_name]
-
-        # Create line chart
-        fig1 = px.line(h, x='fiscal_year', y='spending', color='Agency',title=f'Compare Service Contract Spending - {agency_name}',  color_discrete_sequence=CB_color_cycle) # Create plot, set title and colors
-
-        fig1.update_xaxes(title_text="Fiscal Year",tickmode='linear') # Name x axis, show all axis tixks
-        fig1.update_yaxes(title_text="Contract Funds Obligated ($)",range=[0,180000000000]) # Name y axis
-        fig1.update_layout(height=600,font=dict(size=16),legend=dict(yanchor="bottom",y=-0.4,xanchor="center",x=0.5,orientation="h"),title_x=0.5) # Set plot height, font size, move legent to bottom center, center title
-        fig1.update_traces(line=dict(width=3)) # Increase line thickness
-        fig1.update_traces(mode="markers+lines", hovertemplate=None)
-        h['hoverdata'] = h['spending'].apply(human_format) # Set format of labels
-        fig1.update_layout(hovermode="x")
-        fig1.update_traces(hovertemplate = "%{y}")
-
-        tab2.plotly_chart(fig1, use_container_width=True) # Show plot
-        tab2.caption('Source: USAspending')
-
-        # Filter total spending data to just DoD
-        i = df_all[df_all['Agency']==agency_name]
-
-        fig2 = px.line(i, x='Fiscal Year', y='Obligations', color='Agency',title=f'Compare Total Spending - {agency_name}',  color_discrete_sequence=CB_color_cycle) # Create plot, set title and colors
-
-        fig2.update_xaxes(title_text="Fiscal Year",tickmode='linear') # Name x axis, show all axis ticks
-        max_i = (i['Obligations'].max()*1.1)
-        fig2.update_yaxes(title_text="Total Obligations ($)",range=[0,max_i]) # Name y axis
-        fig2.update_layout(height=600,font=dict(size=16),legend=dict(yanchor="bottom",y=-0.4,xanchor="center",x=0.5,orientation="h"),title_x=0.5) # Set plot height, font size, move legent to bottom center, center title
-        fig2.update_traces(line=dict(width=3)) # Increase line thickness
-        fig2.update_traces(mode="markers+lines", hovertemplate=None)
-        h['hoverdata'] = h['spending'].apply(human_format) # Set format of labels
-        fig2.update_layout(hovermode="x")
-        fig2.update_traces(hovertemplate = "%{y}")# Set format of labels
-
-        tab2.plotly_chart(fig2, use_container_width=True) # Show plot
-        tab2.caption('Source: USAspending')
-
-    else: # If agency name has been selected
-
-        a_list = [agency_name,agency_name2] # Filter data to DoD and agency 2
-        h = df_agencies[df_agencies['Agency'].isin(a_list)]
-
-         # Create double line chart
-        fig1 = px.line(h, x='fiscal_year', y='spending', color='Agency',title=f'Compare Service Contract Spending - {agency_name} and {agency_name2}', color_discrete_sequence=CB_color_cycle) # Create plot, set title and colors
-
-        fig1.update_xaxes(title_text="Fiscal Year",tickmode='linear') # Name x axis
-        fig1.update_yaxes(title_text="Contract Funds Obligated ($)",range=[0,180000000000]) # Name y axis
-        fig1.update_layout(height=600,font=dict(size=16),legend=dict(yanchor="bottom",y=-0.4,xanchor="center",x=0.5,orientation="h"),title_x=0.5) # Set plot height, font size, move legent to bottom center, center title
-        fig1.update_traces(line=dict(width=3)) # Increase line thickness
-        fig1.update_traces(mode="markers+lines", hovertemplate=None)
-        h['hoverdata'] = h['spending'].apply(human_format)
-        fig1.update_layout(hovermode="x")
-        #fig.update_traces(customdata = h['hoverdata'],hovertemplate = "%{customdata}")
-        fig1.update_traces(hovertemplate = "%{y}")
+    a_list = [agency_name] if agency_name2 == ' ' else [agency_name,agency_name2] # Filter data to DoD and agency 2
+    h = df_agencies[df_agencies['Agency'].isin(a_list)]
+    h = h.assign(hoverdata=human_format_array(h['spending'])) # Set format of labels
 
-        tab2.plotly_chart(fig1, use_container_width=True) # Show plot
-        tab2.caption('Source: USAspending')
+    # Create line chart
+    fig1 = px.line(h, x='fiscal_year', y='spending', color='Agency', custom_data=['hoverdata'],title=f'Compare Service Contract Spending - {" and ".join(a_list)}', color_discrete_sequence=CB_color_cycle) # Create plot, set title and colors
 
-        tab2.write(agency_describe)
+    fig1.update_xaxes(title_text="Fiscal Year",tickmode='linear') # Name x axis, show all axis tixks
+    fig1.update_yaxes(title_text="Contract Funds Obligated ($)",range=[0,180000000000]) # Name y axis
+    fig1.update_layout(height=600,font=dict(size=16),legend=dict(yanchor="bottom",y=-0.4,xanchor="center",x=0.5,orientation="h"),title_x=0.5) # Set plot height, font size, move legent to bottom center, center title
+    fig1.update_traces(line=dict(width=3)) # Increase line thickness
+    fig1.update_traces(mode="markers+lines", hovertemplate=None)
+    fig1.update_layout(hovermode="x")
+    fig1.update_traces(hovertemplate = "%{customdata[0]}")
 
-        i = df_all[df_all['Agency'].isin(a_list)]
+    return fig1
 
-        fig2 = px.line(i, x='Fiscal Year', y='Obligations', color='Agency',title=f'Compare Total Spending - {agency_name} and {agency_name2}',  color_discrete_sequence=CB_color_cycle) # Create plot, set title and colors
+@cached_figure
+def total_fig(agency_name, agency_name2):
+    """
+    This function creates a line chart comparing total spending of DoD and another agency.
+    Input: agency name, agency name 2 (' ' if none is selected)
+    Output: Plotly figure
+    """
+    import plotly.express as px
 
-        fig2.update_xaxes(title_text="Fiscal Year",tickmode='linear') # Name x axis
-        max_i = (i['Obligations'].max()*1.1)
-        fig2.update_yaxes(title_text="Total Obligations ($)",range=[0,max_i]) # Name y axis
-        fig2.update_layout(height=600,font=dict(size=16),legend=dict(yanchor="bottom",y=-0.4,xanchor="center",x=0.5,orientation="h"),title_x=0.5) # Set plot height, font size, move legent to bottom center, center title
-        fig2.update_traces(line=dict(width=3)) # Increase line thickness
-        fig2.update_traces(mode="markers+lines", hovertemplate=None)
-        h['hoverdata'] = h['spending'].apply(human_format)
-        fig2.update_layout(hovermode="x")
-        #fig.update_traces(customdata = h['hoverdata'],hovertemplate = "%{customdata}")
-        fig2.update_traces(hovertemplate = "%{y}")
+    df_all = get_data('compare_all_spending')
 
-        tab2.plotly_chart(fig2, use_container_width=True) # Show plot
-        tab2.caption('Source: USAspending')
+    a_list = [agency_name] if agency_name2 == ' ' else [agency_name,agency_name2]
+    i = df_all[df_all['Agency'].isin(a_list)]
+    i = i.assign(hoverdata=human_format_array(i['Obligations'])) # Set format of labels
 
+    fig2 = px.line(i, x='Fiscal Year', y='Obligations', color='Agency', custom_data=['hoverdata'],title=f'Compare Total Spending - {" and ".join(a_list)}',  color_discrete_sequence=CB_color_cycle) # Create plot, set title and colors
 
-    ############# Tab 3
+    fig2.update_xaxes(title_text="Fiscal Year",tickmode='linear') # Name x axis, show all axis ticks
+    max_i = (i['Obligations'].max()*1.1)
+    fig2.update_yaxes(title_text="Total Obligations ($)",range=[0,max_i]) # Name y axis
+    fig2.update_layout(height=600,font=dict(size=16),legend=dict(yanchor="bottom",y=-0.4,xanchor="center",x=0.5,orientation="h"),title_x=0.5) # Set plot height, font size, move legent to bottom center, center title
+    fig2.update_traces(line=dict(width=3)) # Increase line thickness
+    fig2.update_traces(mode="markers+lines", hovertemplate=None)
+    fig2.update_layout(hovermode="x")
+    fig2.update_traces(hovertemplate = "%{customdata[0]}")
 
-    tab3.subheader('How can we breakdown DoD\'s service contracts?')
-    tab3.markdown('<h6 align="left">View data on all service contracts with active transactions in the fiscal year</h6>', unsafe_allow_html=True) # Add a subheader
+    return fig2
 
-    tab3.write(' ')
+@cached_figure
+def breakdown_fig(agency_name, view, mode, years=None, top_n=10, rows_version=None):
+    """
+    This function creates a stacked bar chart of contracts awarded by subagency, office or recipient.
+    With a range of fiscal years, the groups are computed from contract rows by the query engine instead of
+    the precomputed top 10 tables.
+    Input: agency name, view, subtotal method, (first, last) fiscal year (optional), number of groups to show,
+           version of the contract rows (only used to key the figure cache)
+    Output: Plotly figure
+    """
+    import plotly.express as px
 
-    col1, col2, col3, col4, col5, col6 = tab3.columns(6)
-    view = col1.radio('Choose your view:',('Awarding Subagency','Awarding Office','Contract Recipient'))
-    mode = col2.radio('Choose your subtotal method:',('Dollar Value','Number of Contracts'))
-    sub_col_names = {'Awarding Subagency':['awarding_sub_agency_name','subagencies'],'Awarding Office':['awarding_office_name','offices'],'Contract Recipient':['recipient_name','recipients']}
-    sub_list = sub_col_names.get(view)
-    sub_col = sub_list[0]
+    sub_col = sub_col_names.get(view)[0]
 
     if mode == 'Dollar Value':
         sub_data = sub_col
@@ -239,7 +208,12 @@ if __name__ == "__main__":
         Y_label = 'Number of Contracts Awarded'
         Y_title = Y_label
 
-    df_sub = get_data(sub_data)
+    if years is None:
+        df_sub = get_data(sub_data, agency_name)
+    else:
+        with tracing.span('query'):
+            df_sub = query.query([sub_col], 'sum' if mode == 'Dollar Value' else 'count', years=years, top_n=top_n,
+                                 agency=agency_code(agency_name))
     df_sub = df_sub.rename(columns={sub_col:view})
     df_sub = df_sub.sort_values(Y,ascending=False)
     col_title = view.split(' ')[1]
@@ -251,108 +225,72 @@ if __name__ == "__main__":
     fig.update_layout(height=700,font=dict(size=16),showlegend=False,title_x=0.5) # Set plot height, font size, hide legend, and center plot title
     fig.update_traces(hovertemplate = "%{y}")
 
-    tab3.plotly_chart(fig, use_container_width=True) # Show plot
-    tab3.caption('Source: USAspending')
-    #tab3.markdown('<p style="text-align: right;">Source: USAspending</p>', unsafe_allow_html=True)
-
-    plural = sub_list[1]
-    sub_describe = """Though the dollar value of contracts awarded peaked in FY2019, the number of contracts awarded has been
-                decreasing steadily since FY2012. The proportion of funding awarded by larger subagencies and offices remains relatively consistent, indicating
-                that DoD has been awarding more higher-value contracts and fewer low-value contracts."""
-    tab3.write(f'The top 10 {plural} are displayed and all others are grouped together. {sub_describe}')
+    return fig
 
-    ############# Tab 4
-
-    tab4.subheader('What kinds of service contracts is DoD awarding?')
-
-    tab4.write('')
-
-    tab4.write('There are a lot of ways we can categorize federal contracts. These are just a few:')
-
-    tab4a,tab4b,tab4c = tab4.tabs(['NAICS Code','Product or Service Code (PSC)','Contract Bundling'])
-
-    tab4a.markdown('<h4 align="left">What is a NAICS code?</h4>', unsafe_allow_html=True)
-    naicslink = 'https://www.census.gov/programs-surveys/economic-census/year/2022/guidance/understanding-naics.html#:~:text=The%20North%20American%20Industry%20Classification,to%20the%20U.S.%20business%20economy.'
-    tab4a.write(f'[The North American Industry Classification System (NAICS)]({naicslink}) is the standard used by Federal statistical agencies in classifying business establishments for the purpose of collecting, analyzing, and publishing statistical data related to the U.S. business economy. The NAICS code for each contract indicates what industry the contract\'s work falls into.')
-
-    tab4b.markdown('<h4 align="left">What is a PSC code?</h4>', unsafe_allow_html=True)
-    psclink = 'https://www.acquisition.gov/psc-manual.'
-    tab4b.write('A product or service code (PSC)is a four-digit code that describes a product, service, or research and development (R&D) activity purchased by the federal government.')
-
-    tab4b.write(f'The [Product and Service Codes Manual]({psclink}) is maintained by the General Services Administration (GSA) and lists all the existing PSCs, which indicate what the government bought for each contract action reported in the Federal Procurement Data System (FPDS).')
-
-    tab4c.markdown('<h4 align="left">What is contract bundling?</h4>', unsafe_allow_html=True)
-    tab4c.write("""Contract bundling refers to the practice of combining multiple contract requirements into a single procurement, typically for the purpose of achieving
-    cost savings or other efficiencies. In the federal government, contract bundling is governed by the Federal Acquisition Regulation (FAR), which includes specific rules
-    and guidelines for when and how contract bundling can be used.""")
+@cached_figure
+def entity_fig(agency_name, entity, name):
+    """
+    This function creates a bar chart of the value of contracts of one recipient, office or PSC in every fiscal year.
+    Input: agency name, entity id from the search index, entity name
+    Output: Plotly figure
+    """
+    import plotly.express as px
 
-    tab4c.write("""Federal agencies are encouraged to use contract bundling, especially driven by category management efforts, as a way to achieve economies
-    of scale and reduce administrative costs.""")
+    with tracing.span('search_totals'):
+        df_entity = search.totals(agency_code(agency_name), entity)
+    df_entity = df_entity.assign(hoverdata=human_format_array(df_entity['total_obligated_amount'])) # Set format of labels
 
-    tab4.subheader(' ')
+    fig = px.bar(df_entity, x='fiscal_year', y='total_obligated_amount', custom_data=['hoverdata','count'], title=f'{name} - Value of Contracts Awarded', color_discrete_sequence=CB_color_cycle) # Create plot, set title and colors
 
-    tab4.markdown('<h6 align="left">View data on all service contracts with active transactions in the fiscal year</h6>', unsafe_allow_html=True) # Add a subheader
+    fig.update_xaxes(title_text="Fiscal Year",tickmode='linear') # Name x axis, show all axis ticks
+    fig.update_yaxes(title_text='Value of Contracts Awarded($)') # Name y axis
+    fig.update_layout(height=500,font=dict(size=16),title_x=0.5) # Set plot height, font size, and center plot title
+    fig.update_traces(hovertemplate = "%{customdata[0]} <br> %{customdata[1]} contracts<extra></extra>")
 
-    # Create slider to select year and set default value
-    default = 2022
-    year = tab4.slider('Select a fiscal year to view data:',min_value = 2012, max_value = 2022, value = default)
-    default = year
+    return fig
 
-    # Create dictionary of category options
-    categories = {'NAICS Code':'naics_description',
-    'Product or Service Code (PSC)':'product_or_service_code_description',
-                'Contract Bundling':'contract_bundling'}
+@cached_figure
+def category_fig(agency_name, category, year):
+    """
+    This function creates a pie chart of obligations by category for one fiscal year.
+    Input: agency name, category, fiscal year
+    Output: Plotly figure
+    """
+    import plotly.express as px
+    import plotly.graph_objects as go
 
-    # Use radio buttons to select
-    category = tab4.radio("Categorize funds by:",categories.keys())
     col_name = categories[category]
 
     # Get category data based on user selection
-    df_category = get_data(col_name)
+    df_category = get_data(col_name, agency_name)
 
     # Filter data by year
     b = df_category[df_category['fiscal_year']==year]
 
-    b['hoverdata'] = b['total_obligated_amount'].apply(human_format)
+    b = b.assign(hoverdata=human_format_array(b['total_obligated_amount']))
 
     # Create pie chart
     fig = go.Figure(data=[go.Pie(labels=b[col_name], values=b['total_obligated_amount'])]) # Create plot
     fig.update_traces(textfont_size=16,marker=dict(colors=px.colors.qualitative.Prism),rotation=60) # Set colors and font size, and rotate plot 140 degress so that slice labels don't overlap with plot title
     fig.update_layout(height=700,font=dict(size=16),showlegend=True,title=f'{agency_name} - Obligation Breakdown by {category}, FY{year}',title_x=0.5) # Set plot height, font size, title, and center title
     fig.update_traces(customdata=b['hoverdata'],hovertemplate = "%{label} <br> %{percent} </br> %{customdata}<extra></extra>")
-    tab4.plotly_chart(fig, use_container_width=True) # Show plot
-    tab4.caption('Source: USAspending')
-
-    category_describe = """The bulk of service contracts are awards for Engineering and Technical Services, which includes
-    services like information technology management and telecommunications. For these services, DoD seems to prefer to hire contractors over FTEs."""
-
-    category_describe2 = 'Based on FAR, most DoD contracts do not require bundling. FAR places restrictions on bundling to promote competition and preserve award opportunities for small businesses.'
-
-    if category == 'NAICS Code' or category == 'Product or Service Code (PSC)':
-        tab4.write(f'The top 10 codes are displayed and all others are grouped together. {category_describe}')
-        tab4.write(category_describe2)
-    elif category == 'Contract Bundling':
-        tab4.write(category_describe)
-        tab4.write(category_describe2)
-
-    ############# Tab 5
-
-    tab5.subheader('How can we map DoD service contracts?')
 
-    tab5.write('')
+    return fig
 
-    tab5.markdown('<h6 align="left">View data on all service contracts with active transactions in the fiscal year</h6>', unsafe_allow_html=True) # Add a subheader
-
-    # Create slider to select year and set default value
-    default_map = 2022
-    map_year = tab5.slider('Select a fiscal year to map data:',min_value = 2012, max_value = 2022, value = default_map)
-    default_map = map_year
+@cached_figure
+def state_map_fig(agency_name, map_year):
+    """
+    This function creates a choropleth map of the value of service contracts awarded by state for one fiscal year.
+    Input: agency name, fiscal year
+    Output: Plotly figure
+    """
+    import plotly.express as px
 
     # Get state level data
-    df_state_data = get_data('primary_place_of_performance_state_code')
+    df_state_data = get_data('primary_place_of_performance_state_code', agency_name)
     df_state_data = df_state_data.rename(columns={'primary_place_of_performance_state_code':'State'})
 
-    # Merge with shape file to prepare for mapping
+    # Merge with state names to prepare for mapping
     df_state_map = get_geo(df_state_data)
     m = df_state_map[df_state_map['fiscal_year']==map_year]
 
@@ -363,7 +301,7 @@ if __name__ == "__main__":
         val = item[0]
         metrics_reversed[key] = val
 
-    # Create geopandas choropleth map
+    # Create choropleth map
     fig = px.choropleth(m,locations='State', color='total_obligated_amount',
                        color_continuous_scale="Viridis",
                        hover_name='NAME',
@@ -373,34 +311,355 @@ if __name__ == "__main__":
                        labels=metrics_reversed,
                        height=800)
 
-    fig.update_layout(title_text=f'Value of Service Contracts Awarded by State, FY{year}', title_x=0.5,font=dict(size=16)) # Set title and font size
+    fig.update_layout(title_text=f'{agency_name} - Value of Service Contracts Awarded by State, FY{map_year}', title_x=0.5,font=dict(size=16)) # Set title and font size
 
-    tab5.plotly_chart(fig,use_container_width=True)
-    tab5.caption('Source: USAspending')
+    return fig
 
-    tab5.write('The bulk of funding for service contracts is awarded in a handful of states like California, Texas, and Virginia, where there are a large number of military installations and facilities.')
-    tab5.write('Common, recurring, installation-level services, like those that fall into the PSC category Facility Related Services, are especially suited to the implementation of category management practices because the places of performance for these services are usually clustered near one another.')
+def prewarm_figures(version):
+    """
+    This function builds the charts every session opens with, using the same defaults as the tabs, so they are in
+    the figure cache before the first user of a new bundle version asks for them.
+    Input: bundle version (the figures are cached under the current one)
+    Output: None
+    """
+    agency_list = get_data('agencies')['agency'].tolist()
+    agency_name = 'Department of Defense' if 'Department of Defense' in agency_list else agency_list[0]
+    spending_fig(agency_name, ' ')
+    total_fig(agency_name, ' ')
+    for view in sub_col_names:
+        for mode in ['Dollar Value', 'Number of Contracts']:
+            if query.available(agency_code(agency_name)):
+                breakdown_fig(agency_name, view, mode, (2012, 2022), 10, query.version())
+            else:
+                breakdown_fig(agency_name, view, mode)
+    for category in categories:
+        category_fig(agency_name, category, 2022)
+    state_map_fig(agency_name, 2022)
+
+
+#### Tabs
+# Each interactive tab is a fragment, so changing one of its widgets reruns only that tab instead of the whole app.
+# Fragments can only write inside their own body, so they use st.* inside the tab's "with" block.
+
+@fragment
+@tracing.root('compare_agencies_tab')
+def compare_agencies_tab(agency_name):
+    """
+    This function renders Tab 2, comparing an agency's spending with another agency.
+    Input: agency name
+    Output: None
+    """
+    # Import data to compare service contract spending across agencies
+    df_agencies = get_data('compare_agencies')
+    # Create list of agencies to compare
+    df_agencies = df_agencies.rename(columns={'agency':'Agency'})
+
+    agencies = df_agencies['Agency'].unique().tolist() # Convert agency names to list for dropdown menus
+    if agency_name in agencies:
+        agencies.remove(agency_name)
+    agencies = sorted(agencies)
+    agencies.insert(0, ' ')
+
+    st.subheader(f'How does the {agency_name} compare to other agencies?') # Add a subheader
+    st.markdown('<h6 align="left">View data on service contract funds that were newly awarded in the fiscal year</h6>', unsafe_allow_html=True) # Add a subheader
+    agency_name2 = st.selectbox("Compare with another one of the federal agencies that leads in service contracting:", agencies) # Store user selection for agency name 2
+
+    agency_describe = """DoD far outranks all other federal agencies in its service contract spending, which has been extremely proportional to its total spending over time.
+                    Not all other agencies see their contract spending trends mirrored in their total spending to the same degree."""
+
+    with tracing.span('plotly_chart'):
+        st.plotly_chart(spending_fig(agency_name, agency_name2), use_container_width=True) # Show plot
+    st.caption('Source: USAspending')
+
+    if agency_name2 != ' ' and agency_name == 'Department of Defense': # If agency name 2 has been selected
+        st.write(agency_describe)
+
+    with tracing.span('plotly_chart'):
+        st.plotly_chart(total_fig(agency_name, agency_name2), use_container_width=True) # Show plot
+    st.caption('Source: USAspending')
+
+@fragment
+@tracing.root('breakdown_tab')
+def breakdown_tab(agency_name):
+    """
+    This function renders Tab 3, breaking down contracts by subagency, office or recipient.
+    Input: agency name
+    Output: None
+    """
+    st.subheader(f'How can we breakdown {agency_label(agency_name)}\'s service contracts?')
+    st.markdown('<h6 align="left">View data on all service contracts with active transactions in the fiscal year</h6>', unsafe_allow_html=True) # Add a subheader
+
+    st.write(' ')
+
+    col1, col2, col3, col4, col5, col6 = st.columns(6)
+    view = col1.radio('Choose your view:',('Awarding Subagency','Awarding Office','Contract Recipient'))
+    mode = col2.radio('Choose your subtotal method:',('Dollar Value','Number of Contracts'))
+    sub_list = sub_col_names.get(view)
+
+    if query.available(agency_code(agency_name)):
+        # Contract rows are published, so any range of years and number of groups can be shown
+        top_n = col3.number_input('Number of groups:', min_value=1, max_value=50, value=10)
+        years = st.slider('Fiscal years:', 2012, 2022, (2012, 2022))
+        fig = breakdown_fig(agency_name, view, mode, years, int(top_n), query.version())
+    else:
+        top_n = 10
+        fig = breakdown_fig(agency_name, view, mode)
+    with tracing.span('plotly_chart'):
+        st.plotly_chart(fig, use_container_width=True) # Show plot
+    st.caption('Source: USAspending')
+    #st.markdown('<p style="text-align: right;">Source: USAspending</p>', unsafe_allow_html=True)
+
+    plural = sub_list[1]
+    sub_describe = """Though the dollar value of contracts awarded peaked in FY2019, the number of contracts awarded has been
+                decreasing steadily since FY2012. The proportion of funding awarded by larger subagencies and offices remains relatively consistent, indicating
+                that DoD has been awarding more higher-value contracts and fewer low-value contracts."""
+    if agency_name != 'Department of Defense': # The findings below are about DoD
+        sub_describe = ''
+    st.write(f'The top {top_n} {plural} are displayed and all others are grouped together. {sub_describe}')
+
+@fragment
+@tracing.root('search_tab')
+def search_tab(agency_name):
+    """
+    This function renders the lookup in Tab 3, which finds any recipient, office or PSC as the user types and
+    shows its spending in every fiscal year.
+    Input: agency name
+    Output: None
+    """
+    st.markdown('<h4 align="left">Look up a recipient, office or PSC</h4>', unsafe_allow_html=True) # Add a subheader
+
+    code = agency_code(agency_name)
+    with tracing.span('search_index'):
+        ready = search.available(code)
+    if not ready:
+        st.info(f'No search index is available for the {agency_name}.')
+        return
+
+    text = st.text_input('Start typing a name:', placeholder='e.g. Booz Allen Hamilton')
+    if not text:
+        return
+
+    # Matches come from the prebuilt index, so this is quick enough to redo every time the text changes
+    with tracing.span('search'):
+        matches = search.search(code, text)
+    if not matches:
+        st.write(f'No recipients, offices or PSCs match "{text}".')
+        return
+
+    entity, col, name = st.selectbox('Matches:', matches, format_func=lambda match: f'{match[2]} ({search_labels[match[1]]})')
+
+    with tracing.span('plotly_chart'):
+        st.plotly_chart(entity_fig(agency_name, entity, name), use_container_width=True) # Show plot
+    st.caption('Source: USAspending')
+
+@fragment
+@tracing.root('category_tab')
+def category_tab(agency_name):
+    """
+    This function renders the interactive part of Tab 4, a pie chart of obligations by category.
+    Input: agency name
+    Output: None
+    """
+    # Create slider to select year and set default value
+    default = 2022
+    year = st.slider('Select a fiscal year to view data:',min_value = 2012, max_value = 2022, value = default)
+
+    # Use radio buttons to select
+    category = st.radio("Categorize funds by:",categories.keys())
+
+    with tracing.span('plotly_chart'):
+        st.plotly_chart(category_fig(agency_name, category, year), use_container_width=True) # Show plot
+    st.caption('Source: USAspending')
+
+    category_describe = """The bulk of service contracts are awards for Engineering and Technical Services, which includes
+    services like information technology management and telecommunications. For these services, DoD seems to prefer to hire contractors over FTEs."""
+
+    category_describe2 = 'Based on FAR, most DoD contracts do not require bundling. FAR places restrictions on bundling to promote competition and preserve award opportunities for small businesses.'
+
+    if agency_name != 'Department of Defense': # The findings below are about DoD
+        if category != 'Contract Bundling':
+            st.write('The top 10 codes are displayed and all others are grouped together.')
+    elif category == 'NAICS Code' or category == 'Product or Service Code (PSC)':
+        st.write(f'The top 10 codes are displayed and all others are grouped together. {category_describe}')
+        st.write(category_describe2)
+    elif category == 'Contract Bundling':
+        st.write(category_describe)
+        st.write(category_describe2)
+
+@fragment
+@tracing.root('state_map_tab')
+def state_map_tab(agency_name):
+    """
+    This function renders the interactive part of Tab 5, the state map and the contract location map.
+    Input: agency name
+    Output: None
+    """
+    # Create slider to select year and set default value
+    default_map = 2022
+    map_year = st.slider('Select a fiscal year to map data:',min_value = 2012, max_value = 2022, value = default_map)
+
+    with tracing.span('plotly_chart'):
+        st.plotly_chart(state_map_fig(agency_name, map_year),use_container_width=True)
+    st.caption('Source: USAspending')
 
-    tab5.markdown('<h4 align="center">Locations of Contracts for PSC Category 4.4: Facility Related Services, FY2022</h4>', unsafe_allow_html=True) # Add a subheader
+    if agency_name == 'Department of Defense': # The findings below are about DoD
+        st.write('The bulk of funding for service contracts is awarded in a handful of states like California, Texas, and Virginia, where there are a large number of military installations and facilities.')
+        st.write('Common, recurring, installation-level services, like those that fall into the PSC category Facility Related Services, are especially suited to the implementation of category management practices because the places of performance for these services are usually clustered near one another.')
 
-    # Get coordinate data
-    coord_map = get_data('data_coordinates')
+    contract_map(agency_name, map_year)
 
-    # Group contracts by PSC and create list of top 10 to use in selectbox
-    group_codes = pd.DataFrame({'count' : coord_map.groupby(['product_or_service_code_description']).size()}).reset_index()
-    top_codes = group_codes.nlargest(10, 'count')
-    top_codes_list = top_codes['product_or_service_code_description'].tolist()
+@fragment
+@tracing.root('contract_map')
+def contract_map(agency_name, map_year):
+    """
+    This function renders the map of contract locations for one agency and fiscal year, filtered by PSC. It is its
+    own fragment so picking a PSC doesn't rebuild the state map above it.
+    Input: agency name, fiscal year
+    Output: None
+    """
+    st.markdown(f'<h4 align="center">Locations of Contracts for PSC Category 4.4: Facility Related Services, FY{map_year}</h4>', unsafe_allow_html=True) # Add a subheader
+
+    code = agency_code(agency_name)
+
+    # Get the precomputed list of top 10 PSCs to use in selectbox
+    with tracing.span('top_pscs'):
+        top_codes_list = mapbins.top_pscs(code, map_year)
     top_codes_list.insert(0, ' ')
-    psc_code = tab5.selectbox('Select a PSC to filter the map:',top_codes_list)
-    tab5.caption('(Click and drag the map to move to the United States)')
+    psc_code = st.selectbox('Select a PSC to filter the map:',top_codes_list)
+    st.caption('(Click and drag the map to move to the United States)')
+
+    # Get contract locations binned to a bounded number of points, for all contracts or just the selected PSC
+    with tracing.span('map_bins'):
+        bins = mapbins.map_bins(code, map_year, mapbins.ALL if psc_code == ' ' else psc_code)
+
+    if bins is None:
+        st.info(f'No contract locations are available for FY{map_year}.')
+    else:
+        with tracing.span('st_map'):
+            st.map(bins,zoom=3,size='size')
+
+    st.caption('Source: USAspending')
+
+
+#### App starts here
+if __name__ == "__main__":
+    requested = tracing.panel_requested() # Always checked, so the panel also opens when DODAPP_TRACE is on
+    tracing.begin('app', tracing.TRACE or requested) # Record this rerun if tracing is on (see tracing.py)
+    # Always end the record, also when the rerun is interrupted by a new one, st.stop() or an error, so that
+    # later fragment reruns are not recorded as spans of a rerun that is never logged
+    try:
+        # Check for new bundle versions in the background from the first session on, so a publish is picked up (and
+        # with DODAPP_PREWARM=1 loaded, default charts included) before any user asks for it
+        databundle.on_prewarm('figures', prewarm_figures)
+        databundle.watch()
+
+        # Let the user pick any agency whose data has been published, DoD by default
+        agency_list = get_data('agencies')['agency'].tolist()
+        agency_name = 'Department of Defense'
+        if len(agency_list) > 1:
+            agency_name = st.selectbox('Choose an agency:', agency_list, index=agency_list.index(agency_name) if agency_name in agency_list else 0)
+
+        #st.markdown('<h2 align="left">How much money does the federal government spend?</h2>', unsafe_allow_html=True) # Add app title
+        st.title(f'{agency_name} Service Contracting')
+        st.header('Opportunities for Category Management')
+        st.write('')
+
+        # Create tabs for the different visualizations
+        tab1, tab2, tab3, tab4, tab5 = st.tabs(['Understanding the Context', 'Comparing Other Agencies','Breaking Down Contracts Awarded','Categorizing Contract Types','Mapping Contracts Awarded'])
+
+        ############## Tab 1
+
+        tab1.write('')
+
+        # Store links to external information
+        usasplink = 'https://www.usaspending.gov/search'
+        gaolink = 'https://www.gao.gov/products/hr-93-8'
+        gsalink = 'https://www.gsa.gov/buy-through-us/category-management#:~:text=Category%20Management%20is%20the%20practice,and%20effectiveness%20of%20acquisition%20activities'
+
+        tab1.subheader('DoD leads in spending on service contracts, and some are concerned')
+        tab1.write(f'For at least the past decade, the Department of Defense (DoD) has spent more on contracts for services than any other federal agency every fiscal year. [DoD contracting has been on the General Accountability Office\'s (GAO) High-Risk List since 1992]({gaolink}), having been identified as an operation that is highly vulnerable to fraud, waste, abuse, and mismanagement.')
+
+        tab1.write('')
+
+        tab1.subheader('Category management is a possible solution')
+        tab1.write(f'[Category management]({gsalink}) is a strategy that helps organizations make smarter, more cost-effective purchases of goods and services by identifying core spending categories and making those acquisitions as a combined enterprise, allowing for the consolidation and reduction of contracts. In doing so, organizations can also reduce the amount of time and resources spent on procuring services and managing ongoing contracts.')
+
+        #cm = Image.open('https://github.com/abdelkaderalia/DoDContractApp/blob/main/Images/cm.png?raw=true')
+        #tab1.image(image,caption='Source: Acquisition.gov')
+
+        tab1.write('')
+
+        tab1.subheader("""Exploring trends in contract spending can demonstrate the potential for category management""")
+        tab1.write('Visualizing contract data can illuminate not only the magnitude of DoD’s contractual service spending but also highlight the potential benefit of a wider implementation of category management.')
+
+        tab1.write('')
+
+        tab1.subheader("""Data source and limitations""")
+
+        tab1.write(f'[USAspending]({usasplink}), a service run by the Department of the Treasury, publishes data on contracts as submitted by agencies to the Federal Procurement Data System.')
+
+        tab1.markdown("""This interactive web app features USAspending data for *prime award contracts for services only.* This does not include contracts to purchase physical products,
+        subaward contracts, or indefinite delivery vehicles (IDVs, a type of contract that allows the purchaser to buy an indefinite quantity of products or services over a fixed time period.)""")
+
+        ############# Tab 2
+
+        with tab2:
+            compare_agencies_tab(agency_name)
+
+        ############# Tab 3
+
+        with tab3:
+            breakdown_tab(agency_name)
+            search_tab(agency_name)
+
+        ############# Tab 4
+
+        tab4.subheader(f'What kinds of service contracts is {agency_label(agency_name)} awarding?')
+
+        tab4.write('')
+
+        tab4.write('There are a lot of ways we can categorize federal contracts. These are just a few:')
+
+        tab4a,tab4b,tab4c = tab4.tabs(['NAICS Code','Product or Service Code (PSC)','Contract Bundling'])
+
+        tab4a.markdown('<h4 align="left">What is a NAICS code?</h4>', unsafe_allow_html=True)
+        naicslink = 'https://www.census.gov/programs-surveys/economic-census/year/2022/guidance/understanding-naics.html#:~:text=The%20North%20American%20Industry%20Classification,to%20the%20U.S.%20business%20economy.'
+        tab4a.write(f'[The North American Industry Classification System (NAICS)]({naicslink}) is the standard used by Federal statistical agencies in classifying business establishments for the purpose of collecting, analyzing, and publishing statistical data related to the U.S. business economy. The NAICS code for each contract indicates what industry the contract\'s work falls into.')
+
+        tab4b.markdown('<h4 align="left">What is a PSC code?</h4>', unsafe_allow_html=True)
+        psclink = 'https://www.acquisition.gov/psc-manual.'
+        tab4b.write('A product or service code (PSC)is a four-digit code that describes a product, service, or research and development (R&D) activity purchased by the federal government.')
+
+        tab4b.write(f'The [Product and Service Codes Manual]({psclink}) is maintained by the General Services Administration (GSA) and lists all the existing PSCs, which indicate what the government bought for each contract action reported in the Federal Procurement Data System (FPDS).')
+
+        tab4c.markdown('<h4 align="left">What is contract bundling?</h4>', unsafe_allow_html=True)
+        tab4c.write("""Contract bundling refers to the practice of combining multiple contract requirements into a single procurement, typically for the purpose of achieving
+        cost savings or other efficiencies. In the federal government, contract bundling is governed by the Federal Acquisition Regulation (FAR), which includes specific rules
+        and guidelines for when and how contract bundling can be used.""")
+
+        tab4c.write("""Federal agencies are encouraged to use contract bundling, especially driven by category management efforts, as a way to achieve economies
+        of scale and reduce administrative costs.""")
+
+        tab4.subheader(' ')
+
+        tab4.markdown('<h6 align="left">View data on all service contracts with active transactions in the fiscal year</h6>', unsafe_allow_html=True) # Add a subheader
+
+        with tab4:
+            category_tab(agency_name)
+
+        ############# Tab 5
+
+        tab5.subheader(f'How can we map {agency_label(agency_name)} service contracts?')
+
+        tab5.write('')
+
+        tab5.markdown('<h6 align="left">View data on all service contracts with active transactions in the fiscal year</h6>', unsafe_allow_html=True) # Add a subheader
 
-    # If PSC is not selected, show all contracts on map
-    if psc_code == ' ':
-        tab5.map(coord_map,3)
+        with tab5:
+            state_map_tab(agency_name)
+    finally:
+        tracing.end()
 
-    # If PSC is selected, filter data and then map
-    elif psc_code != ' ':
-        filter_map = coord_map[coord_map['product_or_service_code_description']==psc_code]
-        tab5.map(filter_map,3)
+    ############# Performance panel
 
-    tab5.caption('Source: USAspending')
+    tracing.panel()
@@ -0,0 +1,95 @@
+import functools
+import os
+import threading
+from collections import OrderedDict
+
+import plotly.io as pio
+
+import databundle
+import figpost
+import tracing
+
+#### Setup
+
+# Limits for the figure cache, shared by every session in the process
+MAX_ENTRIES = int(os.environ.get('DODAPP_FIGCACHE_ENTRIES', 512))
+MAX_BYTES = int(os.environ.get('DODAPP_FIGCACHE_MB', 64)) * 1024 * 1024
+
+#### Functions
+
+class FigureCache:
+    """
+    Bounded LRU cache of serialized figures. Entries are evicted oldest first once either the number of entries
+    or their total size in bytes goes over its limit.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old)
+            self._entries[key] = value
+            self.nbytes += size
+            while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+FIGURES = FigureCache()
+
+# Figures of an older bundle version can never be hit again
+databundle.on_invalidate(lambda version: FIGURES.clear())
+
+def cached_figure(func):
+    """
+    This decorator memoizes a function that builds a Plotly figure. The figure is slimmed down (see figpost.py)
+    and its JSON is cached per (function, arguments, data bundle version), so a new bundle never serves stale charts.
+    Input: function returning a go.Figure, called with hashable arguments only
+    Output: wrapped function returning a go.Figure
+    """
+    @functools.wraps(func)
+    def wrapper(*args):
+        with tracing.span(func.__name__):
+            key = (func.__name__, args, databundle.current_version())
+            fig_json = FIGURES.get(key)
+            tracing.count('figure_cache.miss' if fig_json is None else 'figure_cache.hit')
+            if fig_json is None:
+                with tracing.span('build'):
+                    fig = func(*args)
+                with tracing.span('slim'):
+                    fig = figpost.slim(fig)
+                with tracing.span('to_json'):
+                    fig_json = fig.to_json()
+                FIGURES.put(key, fig_json)
+            with tracing.span('from_json'):
+                return pio.from_json(fig_json)
+    return wrapper
@@ -0,0 +1,72 @@
+import numpy as np
+
+#### Setup
+
+# Numbers are rounded to this many decimals, finer than anything the charts show (amounts are in dollars)
+DECIMALS = 2
+
+# Scatter traces with more points than this are drawn with WebGL
+WEBGL_POINTS = 1000
+
+# Trace attributes that hold one value per point
+ARRAY_ATTRS = ['x', 'y', 'z', 'values', 'lat', 'lon', 'customdata']
+
+#### Functions
+
+def compact(values):
+    """
+    This function rounds an array of numbers to display precision and stores it in the narrowest dtype that holds it.
+    Plotly writes numpy arrays as base64 typed arrays, so narrower dtypes mean smaller payloads. Anything that is not
+    numeric is returned as it is.
+    Input: array-like
+    Output: np.ndarray, or the input unchanged
+    """
+    arr = np.asarray(values)
+    if arr.dtype.kind == 'f':
+        arr = np.round(arr, DECIMALS)
+        if arr.size and np.isfinite(arr).all() and (arr == np.round(arr)).all():
+            arr = arr.astype(np.int64)
+    if arr.dtype.kind in 'iu' and arr.size:
+        for dtype in (np.int8, np.int16, np.int32):
+            info = np.iinfo(dtype)
+            if info.min <= arr.min() and arr.max() <= info.max:
+                return arr.astype(dtype)
+        return arr
+    return arr if arr.dtype.kind == 'f' else values
+
+def slim(fig):
+    """
+    This function shrinks a figure before it is cached and sent to the browser: per-point data that no template
+    refers to is dropped, numbers are rounded and narrowed (see compact), and large scatter traces switch to WebGL.
+    Input: go.Figure
+    Output: go.Figure (the same one, or a new one if a trace was switched to WebGL)
+    """
+    import plotly.graph_objects as go
+
+    traces, switched = [], False
+    for trace in fig.data:
+        template = trace['hovertemplate'] if 'hovertemplate' in trace else None
+        templates = ' '.join(str(trace[k]) for k in ('hovertemplate', 'texttemplate') if k in trace and trace[k])
+        # Extra columns only reach the browser through templates
+        if 'customdata' in trace and trace.customdata is not None and 'customdata' not in templates:
+            trace.customdata = None
+        if 'hovertext' in trace and trace.hovertext is not None and template and 'hovertext' not in template:
+            trace.hovertext = None
+
+        for attr in ARRAY_ATTRS:
+            if attr in trace and trace[attr] is not None:
+                trace[attr] = compact(trace[attr])
+
+        if trace.type == 'scatter' and trace.x is not None and len(trace.x) > WEBGL_POINTS:
+            props = trace.to_plotly_json()
+            props.pop('type')
+            try:
+                trace = go.Scattergl(props)
+                switched = True
+            except ValueError: # Uses something WebGL can't draw, keep the SVG trace
+                pass
+        traces.append(trace)
+
+    if switched:
+        fig = go.Figure(data=traces, layout=fig.layout)
+    return fig
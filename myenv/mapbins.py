@@ -0,0 +1,107 @@
+import databundle
+
+#### Setup
+
+PSC = 'product_or_service_code_description'
+ALL = 'ALL' # PSC partition holding every contract, see py/build_map_bins.py
+
+# Most bins sent to the browser for one map
+MAX_POINTS = 5000
+
+# Approximate width of a geohash cell in meters, by precision
+CELL_METERS = {1: 5000000, 2: 1250000, 3: 156000, 4: 39100, 5: 4890, 6: 1220}
+
+# Geocoded contracts the map was drawn from before bins were published (FY2022 DoD contracts from the Geocoding
+# notebook), still used for an agency without bins
+LEGACY_TABLE = 'data_coordinates'
+LEGACY_AGENCY = '097'
+LEGACY_YEAR = 2022
+
+#### Functions
+
+def _index(agency):
+    """
+    This function splits the map bins of one agency into one dataframe per fiscal year, PSC and precision. The split
+    is kept in the data cache, within its memory budget, until a new bundle version is published.
+    Input: agency code
+    Output: dict of (fiscal_year, PSC, precision) -> pd.DataFrame
+    """
+    version = databundle.current_version()
+
+    def build():
+        bins = databundle.read_table(f'agency={agency}/map_bins', version)
+        return {key: part.reset_index(drop=True) for key, part in bins.groupby(['fiscal_year', PSC, 'precision'], sort=False, observed=True)}
+
+    def nbytes(index):
+        return sum(databundle.frame_bytes(part) for part in index.values())
+
+    return databundle.read_derived(f'agency={agency}/map_bins:index', build, nbytes, version)
+
+def _legacy(agency, year):
+    """
+    This function loads the contracts geocoded before map bins were published, if they cover an agency and year.
+    Input: agency code, fiscal year
+    Output: pd.DataFrame with PSC, lat and lon columns, None if not available
+    """
+    if agency != LEGACY_AGENCY or year != LEGACY_YEAR:
+        return None
+    try:
+        coords = databundle.read_table(LEGACY_TABLE)
+    except (KeyError, OSError):
+        return None
+    return coords[[PSC, 'lat', 'long']].rename(columns={'long': 'lon'}).dropna(subset=['lat', 'lon'])
+
+def top_pscs(agency, year, n=10):
+    """
+    This function returns the PSCs with the most contracts of an agency in a fiscal year, for the map filter.
+    Input: agency code, fiscal year, number of PSCs
+    Output: list of PSC descriptions, empty if no contract locations have been published
+    """
+    try:
+        top = databundle.read_table(f'agency={agency}/map_top_psc')
+    except (KeyError, OSError): # Not in the bundle, or no bundle and the remote fallback failed
+        coords = _legacy(agency, year)
+        if coords is None:
+            return []
+        counts = coords[PSC].value_counts()
+        return counts[counts > 0].head(n).index.tolist()
+    top = top[(top['fiscal_year']==year) & (top['rank']<=n)].sort_values('rank')
+    return top[PSC].tolist()
+
+def map_bins(agency, year, psc=ALL, max_points=MAX_POINTS, bbox=None):
+    """
+    This function picks the most detailed set of bins for a map view that stays within the point budget.
+    Input: agency code, fiscal year, PSC (ALL for every contract), max number of bins,
+           bounding box (min_lat, min_lon, max_lat, max_lon) of the viewport (optional)
+    Output: pd.DataFrame of bins with lat, lon, count, total_obligated_amount and a size column (meters) for st.map,
+            None if there are no bins for the selection
+    """
+    try:
+        index = _index(agency)
+    except (KeyError, OSError):
+        # No bins yet, so send every contract like the map did before them
+        coords = _legacy(agency, year)
+        if coords is None:
+            return None
+        coords = coords if psc == ALL else coords[coords[PSC] == psc]
+        return coords.assign(lat=coords['lat'].astype('float64'), lon=coords['lon'].astype('float64'),
+                             size=CELL_METERS[5] / 2)
+    precisions = sorted((p for (y, c, p) in index if y == year and c == psc), reverse=True)
+    if not precisions:
+        return None
+
+    for precision in precisions:
+        bins = index[(year, psc, precision)]
+        if bbox is not None:
+            min_lat, min_lon, max_lat, max_lon = bbox
+            bins = bins[bins['lat'].between(min_lat, max_lat) & bins['lon'].between(min_lon, max_lon)]
+        if len(bins) <= max_points:
+            break
+    else:
+        # Even the coarsest bins are over budget, so keep the biggest ones
+        bins = bins.nlargest(max_points, 'count')
+
+    # Scale dots by the number of contracts, up to half a cell wide
+    size = CELL_METERS.get(precision, 1000) / 2 * (bins['count'] / bins['count'].max()) ** 0.5
+    # Bundles store coordinates as float32, which st.map can't serialize to JSON
+    return bins.assign(lat=bins['lat'].astype('float64'), lon=bins['lon'].astype('float64'), size=size)
@@ -0,0 +1,197 @@
+import functools
+import os
+import threading
+from pathlib import Path
+
+#### Setup
+
+# Contract rows written by py/aggregate.py --contracts-dir, partitioned as agency=<code>/fiscal_year=YYYY/part-0.parquet,
+# with every single-dimension group per agency and fiscal year precomputed in groups.parquet
+CONTRACTS_DIR = Path(os.environ.get('DODAPP_CONTRACTS_DIR', Path(__file__).resolve().parent.parent / 'Clean Data' / 'Contracts'))
+
+AMOUNT = 'total_obligated_amount'
+
+# Columns that can be grouped or filtered on
+DIMENSIONS = ['awarding_sub_agency_name',
+              'awarding_office_name',
+              'recipient_name',
+              'primary_place_of_performance_state_code',
+              'product_or_service_code_description',
+              'dod_claimant_program_description',
+              'type_of_contract_pricing',
+              'award_type',
+              'contract_bundling',
+              'solicitation_procedures',
+              'naics_description']
+
+# SQL for each measure, named like the columns of the Plot Data tables
+MEASURES = {'sum': f'SUM({AMOUNT}) AS {AMOUNT}',
+            'count': 'COUNT(*) AS count'}
+
+_lock = threading.Lock()
+_conn = None
+_has_groups = False
+_ranked = False # Whether groups.parquet has the ranks written by py/aggregate.py
+_version = None
+_published = None # Modification time of groups.parquet when the connection was opened
+
+#### Functions
+
+def available(agency='*', contracts_dir=None):
+    """
+    This function checks whether contract rows have been published for the query engine.
+    Input: agency code (optional, any agency by default), contracts folder (optional)
+    Output: bool
+    """
+    return any(Path(contracts_dir or CONTRACTS_DIR).glob(f'agency={agency}/fiscal_year=*/*.parquet'))
+
+def _groups_mtime():
+    """
+    This function returns when groups.parquet was last published. py/aggregate.py replaces it after every contract
+    partition is written, so it marks a new set of contract rows.
+    Input: None
+    Output: modification time (int), None if it has not been published
+    """
+    try:
+        return (CONTRACTS_DIR / 'groups.parquet').stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def _cursor():
+    """
+    This function returns a cursor on the process-wide DuckDB connection, which has a contracts view over the
+    Parquet partitions and, if it was published, a groups table of precomputed single-dimension aggregates. Each
+    call gets its own cursor so sessions can query from different threads. A new connection is opened when
+    groups.parquet changes, so the groups table never disagrees with the contract rows. The old one is not closed,
+    since other sessions may still be querying through its cursors; it goes away with the last of them.
+    Input: None
+    Output: duckdb cursor
+    """
+    global _conn, _has_groups, _ranked, _version, _published
+    published = _groups_mtime()
+    with _lock:
+        if published != _published:
+            _conn = None
+        if _conn is None:
+            import duckdb # Only needed once someone queries contract rows
+
+            conn = duckdb.connect()
+            glob = str(CONTRACTS_DIR / 'agency=*' / 'fiscal_year=*' / '*.parquet').replace("'", "''")
+            # Agency codes have leading zeros, so they are kept as text; filters on either key skip whole partitions
+            conn.execute(f"CREATE VIEW contracts AS SELECT * FROM read_parquet('{glob}', hive_partitioning = true, "
+                         f"hive_types = {{'agency': VARCHAR, 'fiscal_year': BIGINT}})")
+            groups = CONTRACTS_DIR / 'groups.parquet'
+            if groups.exists():
+                # Small enough to keep in memory, and it answers most questions on its own
+                path = str(groups).replace("'", "''")
+                conn.execute(f"CREATE TABLE groups AS SELECT * FROM read_parquet('{path}') ORDER BY dimension, agency, fiscal_year")
+            _has_groups = groups.exists()
+            _ranked = _has_groups and 'rank_sum' in [row[0] for row in conn.execute('DESCRIBE groups').fetchall()]
+            _version = max((p.stat().st_mtime_ns for p in CONTRACTS_DIR.rglob('*.parquet')), default=0)
+            _published = published
+            _conn = conn
+        return _conn.cursor()
+
+def version():
+    """
+    This function identifies the contract rows the connection was opened on, so results built from them can be
+    cached until new rows are published.
+    Input: None
+    Output: latest modification time of the Parquet files (int)
+    """
+    _cursor().close()
+    return _version
+
+def reset():
+    """
+    This function drops the DuckDB connection, so newly written partitions are picked up by the next query. Cursors
+    already handed out keep working on the old one.
+    Input: None
+    Output: None
+    """
+    global _conn
+    with _lock:
+        _conn = None
+
+@functools.lru_cache(maxsize=64)
+def _groups_result(sql, params, published):
+    """
+    This function runs a top n query on the groups table, keeping its result until new contract rows are published.
+    Input: SQL, parameters (tuple), modification time of groups.parquet the query was built for
+    Output: pd.DataFrame
+    """
+    return _cursor().execute(sql, list(params)).df()
+
+def query(dimensions, measure='sum', filters=None, years=None, top_n=10, per_year=True, agency=None):
+    """
+    This function aggregates contract rows by fiscal year and one or more dimensions, keeping the top n groups
+    and adding everything else together as "OTHER". Only the partitions of the agency and years asked for are read.
+    Input: list of dimensions, measure ('sum' of obligations or 'count' of contracts),
+           filters as dict of dimension -> value or list of values, (first, last) fiscal year,
+           number of groups to keep (None for all), whether the top n is taken per fiscal year or over the whole range,
+           agency code (optional, every agency by default)
+    Output: pd.DataFrame with columns [*dimensions, measure column, fiscal_year]
+    """
+    dimensions = list(dimensions)
+    for col in dimensions + list(filters or {}):
+        if col not in DIMENSIONS:
+            raise ValueError(f'Unknown dimension {col}')
+    if measure not in MEASURES:
+        raise ValueError(f'Unknown measure {measure}, expected one of {list(MEASURES)}')
+    value = AMOUNT if measure == 'sum' else 'count'
+
+    where, params = [f'{col} IS NOT NULL' for col in dimensions], []
+    keys, key_params = [], [] # Partition filters, shared with the groups table
+    if agency is not None:
+        keys.append('agency = ?')
+        key_params.append(str(agency))
+    if years is not None:
+        keys.append('fiscal_year BETWEEN ? AND ?')
+        key_params += [int(years[0]), int(years[1])]
+    where += keys
+    params += key_params
+    for col, vals in (filters or {}).items():
+        vals = [vals] if isinstance(vals, str) else list(vals)
+        where.append(f'{col} IN ({", ".join("?" * len(vals))})')
+        params += vals
+    where_sql = f'WHERE {" AND ".join(where)}' if where else ''
+
+    dims = ', '.join(dimensions)
+    total = f'SUM({value})' if measure == 'sum' else f'CAST(SUM({value}) AS BIGINT)'
+    cursor = _cursor()
+    from_groups = len(dimensions) == 1 and not filters and _has_groups
+    if from_groups:
+        # One dimension without filters is already aggregated per year, no need to scan contract rows
+        col = dimensions[0]
+        params = [col] + key_params
+        where_sql = 'WHERE ' + ' AND '.join(['dimension = ?'] + keys)
+        if _ranked and agency is not None and per_year and top_n is not None:
+            # Groups are ranked within each agency and year, so the top n are the first n rows and the next one
+            # carries the total of everything else
+            n, rank, rest = int(top_n), f'rank_{measure}', f'rest_{measure}'
+            sql = (f'SELECT CASE WHEN {rank} <= {n} THEN "group" ELSE \'OTHER\' END AS {col}, '
+                   f'CASE WHEN {rank} <= {n} THEN {value} ELSE {rest} END AS {value}, fiscal_year '
+                   f'FROM groups {where_sql} AND {rank} <= {n + 1} ORDER BY fiscal_year, {value}')
+            return cursor.execute(sql, params).df()
+        grouped = f'SELECT fiscal_year, "group" AS {col}, {total} AS {value} FROM groups {where_sql} GROUP BY ALL'
+    else:
+        grouped = f'SELECT fiscal_year, {dims}, {MEASURES[measure]} FROM contracts {where_sql} GROUP BY fiscal_year, {dims}'
+
+    if top_n is None:
+        sql = f'SELECT {dims}, {value}, fiscal_year FROM ({grouped}) ORDER BY fiscal_year, {value}'
+    else:
+        # Rank groups within each year, or by their total over the range, and fold the rest into OTHER
+        if per_year:
+            ranked = f'SELECT *, ROW_NUMBER() OVER (PARTITION BY fiscal_year ORDER BY {value} DESC, {dims}) AS rn FROM g'
+        else:
+            ranked = (f'SELECT g.*, t.rn FROM g JOIN (SELECT {dims}, ROW_NUMBER() OVER (ORDER BY SUM({value}) DESC, {dims}) AS rn '
+                      f'FROM g GROUP BY {dims}) t USING ({dims})')
+        labels = ', '.join(f"CASE WHEN rn <= {int(top_n)} THEN {col} ELSE 'OTHER' END AS {col}" for col in dimensions)
+        sql = (f'WITH g AS ({grouped}), r AS ({ranked}) '
+               f'SELECT {labels}, {total} AS {value}, fiscal_year FROM r '
+               f'GROUP BY ALL ORDER BY fiscal_year, {value}')
+
+    if from_groups and top_n is not None:
+        # Ranking over a range of years or every agency re-aggregates each group, so the result is kept
+        return _groups_result(sql, tuple(params), _published).copy()
+    return cursor.execute(sql, params).df()
@@ -0,0 +1,165 @@
+import bisect
+import re
+import sys
+import unicodedata
+
+import numpy as np
+
+import databundle
+
+#### Setup
+
+AMOUNT = 'total_obligated_amount'
+
+# Characters left after normalizing; a trigram is numbered by its three positions in base 37
+ALPHABET = ' 0123456789abcdefghijklmnopqrstuvwxyz'
+_POSITION = {c: i for i, c in enumerate(ALPHABET)}
+
+# Most matches returned for one search
+LIMIT = 20
+
+# Share of the typed trigrams a name must contain to count as a fuzzy match
+MIN_SIMILARITY = 0.5
+
+#### Functions
+
+def normalize(text):
+    """
+    This function reduces a name or typed text to the form it is searched by: lowercase ASCII letters and digits
+    separated by single spaces. py/search_index.py indexes names with this same function.
+    Input: text (string)
+    Output: normalized text (string)
+    """
+    text = unicodedata.normalize('NFKD', str(text)).encode('ascii', 'ignore').decode()
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', text.lower()).split())
+
+def trigrams(key):
+    """
+    This function numbers the trigrams of the words of normalized text, each word padded with two spaces in front
+    and one behind so that word starts weigh more than word ends.
+    Input: normalized text (string)
+    Output: np.ndarray of distinct trigram codes
+    """
+    grams = set()
+    for word in key.split():
+        pos = [_POSITION[c] for c in f'  {word} ']
+        grams.update(pos[i] * 1369 + pos[i + 1] * 37 + pos[i + 2] for i in range(len(pos) - 2))
+    return np.fromiter(grams, dtype=np.int64, count=len(grams))
+
+def _index(version, agency):
+    """
+    This function loads the search index of one agency into arrays. Names and keys stay in the bundle's shared
+    label dictionaries; only their integer codes are kept here.
+    Input: bundle version, agency code
+    Output: dict with the names table, the key and dimension codes of every entity, their trigram postings and
+            counts, their total obligations over all years, and the per-year totals sorted by entity
+    """
+    names = databundle.read_table(f'agency={agency}/search_names', version)
+    grams = databundle.read_table(f'agency={agency}/search_trigrams', version)
+    totals = databundle.read_table(f'agency={agency}/search_totals', version)
+    n = len(names)
+
+    # The postings of each trigram are a contiguous run of the table, which is sorted by trigram
+    codes, ids = grams['trigram'].to_numpy(np.int64), grams['id'].to_numpy(np.int64)
+    unique, first = np.unique(codes, return_index=True)
+    postings = dict(zip(unique.tolist(), np.split(ids, first[1:])))
+
+    total_ids = totals['id'].to_numpy(np.int64)
+    # Keys are sorted, and so is their dictionary, so the codes of the keys increase along the table. The
+    # dictionary is the bundle's own string array, shared by every agency, not a copy
+    return {'names': names,
+            'keys': names['key'].cat.categories.values,
+            'key_codes': names['key'].cat.codes.to_numpy(),
+            'dimensions': names['dimension'].cat.categories,
+            'dimension_codes': names['dimension'].cat.codes.to_numpy(),
+            'postings': postings,
+            'ntrigrams': np.bincount(ids, minlength=n),
+            'overall': np.bincount(total_ids, weights=totals[AMOUNT].to_numpy(float), minlength=n),
+            'totals': totals,
+            'total_ids': total_ids}
+
+def _index_bytes(index):
+    """
+    This function measures the memory held by a search index, leaving out the label dictionaries it shares.
+    Input: index (dict)
+    Output: bytes (int)
+    """
+    arrays = ['key_codes', 'dimension_codes', 'ntrigrams', 'overall', 'total_ids']
+    postings = index['postings']
+    return (databundle.frame_bytes(index['names']) + databundle.frame_bytes(index['totals'])
+            + sum(index[name].nbytes for name in arrays)
+            + sys.getsizeof(postings) + sum(sys.getsizeof(ids) + ids.nbytes for ids in postings.values()))
+
+def _load(agency):
+    """
+    This function returns the search index of an agency for the current bundle version. The index is kept in the
+    data cache, within its memory budget, until a new bundle version is published.
+    Input: agency code
+    Output: index (dict), None if no search index has been published for the agency
+    """
+    try:
+        version = databundle.current_version()
+        return databundle.read_derived(f'agency={agency}/search:index', lambda: _index(version, agency), _index_bytes,
+                                       version)
+    except (KeyError, OSError): # Not in the bundle, or no bundle and the remote fallback failed
+        return None
+
+def available(agency):
+    """
+    This function checks whether a search index has been published for an agency.
+    Input: agency code
+    Output: bool
+    """
+    return _load(agency) is not None
+
+def search(agency, text, dimensions=None, limit=LIMIT):
+    """
+    This function finds the recipients, offices and PSCs whose name matches typed text. Names starting with the
+    text come first, by total obligations, then names sharing most of its trigrams, which catches words in the
+    middle of a name and typos.
+    Input: agency code, text, dimensions to search (optional, all by default), max number of matches
+    Output: list of (entity id, dimension, name) tuples, best match first
+    """
+    index, key = _load(agency), normalize(text)
+    if index is None or not key:
+        return []
+    overall = index['overall']
+    allowed = None
+    if dimensions is not None:
+        allowed = np.isin(index['dimension_codes'], index['dimensions'].get_indexer(list(dimensions)))
+
+    # Prefix matches are a contiguous run of the sorted keys, found in the dictionary and then in the codes
+    first, last = bisect.bisect_left(index['keys'], key), bisect.bisect_left(index['keys'], key + '\x7f')
+    lo, hi = np.searchsorted(index['key_codes'], [first, last])
+    prefix = np.arange(lo, hi)
+    if allowed is not None:
+        prefix = prefix[allowed[prefix]]
+    prefix = prefix[np.argsort(-overall[prefix], kind='stable')][:limit]
+
+    found = list(prefix)
+    if len(found) < limit:
+        grams = trigrams(key)
+        hits = [index['postings'][g] for g in grams.tolist() if g in index['postings']]
+        if hits:
+            shared = np.bincount(np.concatenate(hits), minlength=len(overall))
+            similarity = shared / len(grams)
+            fuzzy = np.flatnonzero(similarity >= MIN_SIMILARITY)
+            fuzzy = fuzzy[~np.isin(fuzzy, prefix)]
+            if allowed is not None:
+                fuzzy = fuzzy[allowed[fuzzy]]
+            # Most shared trigrams first, then names with fewer other trigrams, then the biggest totals
+            order = np.lexsort((-overall[fuzzy], index['ntrigrams'][fuzzy], -similarity[fuzzy]))
+            found += list(fuzzy[order][:limit - len(found)])
+
+    rows = index['names'].iloc[found]
+    return [(int(i), dimension, name) for i, dimension, name in zip(found, rows['dimension'], rows['name'])]
+
+def totals(agency, entity):
+    """
+    This function returns the obligations and number of contracts of one entity in every fiscal year.
+    Input: agency code, entity id (from search)
+    Output: pd.DataFrame with fiscal_year, total_obligated_amount and count columns
+    """
+    index = _load(agency)
+    lo, hi = np.searchsorted(index['total_ids'], [entity, entity + 1])
+    return index['totals'].iloc[lo:hi].drop(columns='id').reset_index(drop=True)
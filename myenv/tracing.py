@@ -0,0 +1,217 @@
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+#### Setup
+
+# DODAPP_TRACE=1 records every rerun and logs it as one JSON line, to stderr or to DODAPP_TRACE_FILE.
+# The sidebar panel can also be opened for one session with ?perf=1, or for everyone with DODAPP_PERF_PANEL=1.
+TRACE = os.environ.get('DODAPP_TRACE', '') == '1'
+TRACE_FILE = os.environ.get('DODAPP_TRACE_FILE')
+PANEL = os.environ.get('DODAPP_PERF_PANEL', '') == '1'
+
+# Number of reruns kept per session for the panel
+HISTORY = 20
+
+PANEL_KEY = '_tracing_panel'
+HISTORY_KEY = '_tracing_reruns'
+
+logger = logging.getLogger('dodapp.trace')
+if TRACE and not logger.handlers:
+    handler = logging.FileHandler(TRACE_FILE) if TRACE_FILE else logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_local = threading.local() # The rerun being recorded by this script thread, if any
+
+#### Functions
+
+class _Span:
+    """
+    Times one step of a rerun. Spans nest, and each one is stored with its depth and offset from the start of the rerun.
+    """
+
+    def __init__(self, record, name, attrs):
+        self.record = record
+        self.entry = {'name': name, 'depth': len(record['_open'])}
+        if attrs:
+            self.entry['attrs'] = attrs
+
+    def __enter__(self):
+        self.record['spans'].append(self.entry)
+        self.record['_open'].append(self.entry)
+        self.start = time.perf_counter()
+        self.entry['start_ms'] = round((self.start - self.record['_start']) * 1000, 3)
+        return self.entry
+
+    def __exit__(self, *exc):
+        self.entry['ms'] = round((time.perf_counter() - self.start) * 1000, 3)
+        self.record['_open'].pop()
+        return False
+
+class _NullSpan:
+    """Stands in for a span when nothing is being recorded."""
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL = _NullSpan()
+
+def span(name, **attrs):
+    """
+    This function times a block of code as part of the rerun being recorded. When no rerun is being recorded it
+    returns a shared no-op context manager, so spans cost next to nothing with tracing off.
+    Input: span name, attributes to store with it (optional)
+    Output: context manager
+    """
+    record = getattr(_local, 'record', None)
+    if record is None:
+        return _NULL
+    return _Span(record, name, attrs)
+
+def count(name, n=1):
+    """
+    This function adds to a counter of the rerun being recorded, for example cache hits and misses.
+    Input: counter name, amount
+    Output: None
+    """
+    record = getattr(_local, 'record', None)
+    if record is not None:
+        record['counters'][name] = record['counters'].get(name, 0) + n
+
+def _session_state():
+    """
+    This function returns the Streamlit session state of the current script run, if there is one.
+    Input: None
+    Output: session state or None
+    """
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+    except ImportError:
+        return None
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return None
+    import streamlit as st
+    return st.session_state
+
+def panel_requested():
+    """
+    This function checks whether the performance panel was asked for, for everyone or with ?perf=1 in the URL,
+    and remembers the answer for the fragment reruns of the session.
+    Input: None
+    Output: bool
+    """
+    import streamlit as st
+
+    if PANEL:
+        requested = True
+    elif hasattr(st, 'query_params'):
+        requested = st.query_params.get('perf') == '1'
+    else:
+        requested = st.experimental_get_query_params().get('perf') == ['1']
+    st.session_state[PANEL_KEY] = requested
+    return requested
+
+def begin(name, enabled=None):
+    """
+    This function starts recording a rerun on the current script thread. Full reruns decide whether the session
+    is traced (see panel_requested), and reruns of a single fragment follow that decision.
+    Input: rerun name, whether to record (optional, defaults to DODAPP_TRACE or the panel being open)
+    Output: bool, whether the rerun is recorded
+    """
+    if enabled is None:
+        state = _session_state()
+        enabled = TRACE or bool(state is not None and state.get(PANEL_KEY))
+    if not enabled:
+        _local.record = None
+        return False
+    start = time.perf_counter()
+    _local.record = {'ts': round(time.time(), 3), 'rerun': name, 'spans': [], 'counters': {},
+                     '_start': start, '_open': []}
+    return True
+
+def end():
+    """
+    This function finishes the rerun being recorded, logs it as one JSON line and keeps it in the session history
+    for the panel.
+    Input: None
+    Output: record of the rerun (dict), or None if nothing was recorded
+    """
+    record = getattr(_local, 'record', None)
+    if record is None:
+        return None
+    _local.record = None
+    record['ms'] = round((time.perf_counter() - record.pop('_start')) * 1000, 3)
+    del record['_open']
+
+    state = _session_state()
+    if state is not None:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        record['session'] = get_script_run_ctx(suppress_warning=True).session_id
+        history = state.setdefault(HISTORY_KEY, [])
+        history.append(record)
+        del history[:-HISTORY]
+    if TRACE:
+        logger.info(json.dumps(record))
+    return record
+
+def root(name):
+    """
+    This decorator records a fragment as its own rerun when it reruns on its own, and as a span of the full rerun
+    otherwise.
+    Input: rerun name
+    Output: decorator
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(_local, 'record', None) is not None:
+                with span(name):
+                    return func(*args, **kwargs)
+            if not begin(name):
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                end()
+        return wrapper
+    return decorator
+
+def panel():
+    """
+    This function shows the span breakdown of this session's recent reruns in the sidebar, if the panel was asked
+    for. It is drawn on full reruns and lists the fragment reruns since the last one too.
+    Input: None
+    Output: None
+    """
+    import streamlit as st
+
+    if not st.session_state.get(PANEL_KEY):
+        return
+    history = st.session_state.get(HISTORY_KEY, [])
+    if not history:
+        return
+
+    import pandas as pd
+
+    sidebar = st.sidebar
+    sidebar.subheader('Performance')
+    reruns = pd.DataFrame([{'rerun': r['rerun'], 'ms': r['ms'], **r['counters']} for r in history[::-1]])
+    sidebar.caption('Recent reruns, newest first')
+    sidebar.dataframe(reruns, hide_index=True)
+
+    for i, record in enumerate(history[:-6:-1]):
+        spans = pd.DataFrame([{'span': '\u2003' * s['depth'] + s['name'], 'ms': s.get('ms'),
+                               '% of rerun': round(100 * s.get('ms', 0) / record['ms'], 1) if record['ms'] else None}
+                              for s in record['spans']])
+        with sidebar.expander(f'Spans of {record["rerun"]} ({record["ms"]:.0f} ms)', expanded=i == 0):
+            st.dataframe(spans, hide_index=True)
@@ -0,0 +1,50 @@
+"""
+The agencies covered by this project and their USAspending toptier codes.
+
+Raw award files, per-year aggregates, contract rows and Plot Data tables are partitioned by these codes, in folders
+named agency=<code>. Award archives from the USAspending bulk download carry the code in their name
+(FY2022_097_Contracts_Full_20221008.zip); raw files without one are DoD files from before the data was partitioned.
+"""
+import re
+from pathlib import Path
+
+# Create dictionary of agencies and common government account Codes
+codes = {'Department of Defense':'097',
+        'Department of Energy':'089',
+        'Department of Veterans Affairs':'036',
+        'Department of Health and Human Services':'075',
+        'Department of Homeland Security':'070',
+        'General Services Administration (GSA)':'047',
+        'Department of State':'019',
+        'Department of Transportation':'069',
+        'Department of Justice':'015',
+        'Department of the Interior':'014',
+        'Agency for International Development (USAID)':'072',
+        'National Aeronautics and Space Administration (NASA)':'080'}
+
+names = {code: name for name, code in codes.items()}
+
+DEFAULT_AGENCY = codes['Department of Defense']
+
+#### Functions
+
+def agency_code(path):
+    """
+    This function reads the agency code from a raw file name like FY2022_097_Contracts_Full_20221008.zip.
+    Input: path
+    Output: agency code (string), DoD if the name has none
+    """
+    match = re.search(r'FY\d{4}_(\d{3})(?:_|\.|$)', Path(path).name)
+    if match is None:
+        return DEFAULT_AGENCY
+    if match.group(1) not in names:
+        raise ValueError(f'Unknown agency code {match.group(1)} in {path}')
+    return match.group(1)
+
+def partition(folder, code):
+    """
+    This function returns the folder holding one agency's partition of a dataset.
+    Input: dataset folder, agency code
+    Output: path
+    """
+    return Path(folder) / f'agency={code}'
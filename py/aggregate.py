@@ -0,0 +1,435 @@
+"""
+Aggregate raw USAspending service contract files (CSVs or zipped award archives) into the Plot Data tables used by the app.
+
+This replaces the per-column loops in the Data Cleaning notebook. Each fiscal year file is read once, in chunks
+and with only the columns needed, and every sum and count breakdown is computed in that same pass.
+
+Raw files can cover any agency in py/agencies.py, and everything built from them is partitioned by agency and
+fiscal year. Each agency and fiscal year is a task for a process pool, largest files first so the pool stays
+busy, and each worker writes its own partition of aggregates (and contract rows) without going through the
+parent process. The per-year aggregates are kept in a partials folder together with a manifest of input file
+hashes, so a rerun only reprocesses files that are new or changed and only rebuilds the Plot Data tables of the
+agencies they belong to, in Plot Data/agency=<code>. Every agency also gets a search index over all of its
+recipients, offices and PSCs (see py/search_index.py).
+
+Usage: python py/aggregate.py [--raw-dir DIR] [--out-dir DIR] [--partial-dir DIR] [--workers N] [--chunksize N] [--full] [--contracts-dir [DIR]] [--bundle]
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from agencies import agency_code, names, partition
+from ingest import iter_chunks
+from search_index import SEARCH_TABLES, build_index
+
+REPO = Path(__file__).resolve().parent.parent
+RAW_DIR = REPO / 'Raw Data' / 'Service Contracts'
+OUT_DIR = REPO / 'Clean Data' / 'Plot Data'
+PARTIAL_DIR = REPO / 'Clean Data' / 'Partials'
+CONTRACTS_DIR = REPO / 'Clean Data' / 'Contracts'
+
+# Dimensions that get a breakdown of total obligations by fiscal year
+col_list = ['awarding_sub_agency_name',
+            'awarding_office_name',
+            'recipient_name',
+            'primary_place_of_performance_state_code',
+            'product_or_service_code_description',
+            'dod_claimant_program_description',
+            'type_of_contract_pricing',
+            'award_type',
+            'contract_bundling',
+            'solicitation_procedures',
+            'naics_description']
+
+# Dimensions that also get a breakdown of the number of contracts
+count_list = ['awarding_sub_agency_name',
+              'awarding_office_name',
+              'recipient_name']
+
+# Dimensions that are never cut down to the top 10
+keep_all = ['primary_place_of_performance_state_code']
+
+AMOUNT = 'total_obligated_amount'
+TOP_N = 10
+
+# Contract rows kept for the query engine in the app (see myenv/query.py)
+CONTRACT_SCHEMA = pa.schema([pa.field(AMOUNT, pa.float64())] + [pa.field(col, pa.string()) for col in col_list])
+
+#### Functions
+
+def fiscal_year(path):
+    """
+    This function reads the fiscal year from a raw file name like FY2016.csv.
+    Input: path
+    Output: fiscal year (int)
+    """
+    match = re.search(r'FY(\d{4})', Path(path).name)
+    if match is None:
+        raise ValueError(f'Cannot find a fiscal year in {path}')
+    return int(match.group(1))
+
+def find_files(raw_dir):
+    """
+    This function finds every raw fiscal year file below a folder, either a CSV or a zipped award archive.
+    Input: folder
+    Output: list of paths sorted by agency and fiscal year
+    """
+    paths = [p for p in Path(raw_dir).rglob('*')
+             if p.suffix.lower() in ('.csv', '.zip') and re.search(r'FY\d{4}', p.name)]
+    paths = sorted(paths, key=lambda p: (agency_code(p), fiscal_year(p)))
+    keys = [(agency_code(p), fiscal_year(p)) for p in paths]
+    for agency, year in set(keys):
+        if keys.count((agency, year)) > 1:
+            raise ValueError(f'More than one raw file for {names[agency]} FY{year} in {raw_dir}')
+    return paths
+
+def aggregate_chunks(chunks):
+    """
+    This function computes the sum of obligations and the number of contracts for every dimension over a stream
+    of dataframe chunks. Only one chunk is held in memory at a time.
+    Input: iterable of pd.DataFrame
+    Output: dict of dimension -> pd.DataFrame indexed by group with total_obligated_amount and count columns
+    """
+    partials = {}
+    for chunk in chunks:
+        for col in col_list:
+            part = chunk.groupby(col, sort=False)[AMOUNT].agg(['sum', 'size'])
+            part.columns = [AMOUNT, 'count']
+            if col in partials:
+                part = pd.concat([partials[col], part]).groupby(level=0).sum()
+            partials[col] = part
+    return partials
+
+def contracts_path(agency, year, contracts_dir=CONTRACTS_DIR):
+    """
+    This function returns where the contract rows of one agency and fiscal year are stored, as a Hive-style partition.
+    Input: agency code, fiscal year, contracts folder
+    Output: path
+    """
+    return partition(contracts_dir, agency) / f'fiscal_year={year}' / 'part-0.parquet'
+
+def write_contracts(chunks, path):
+    """
+    This function passes dataframe chunks through while also writing them to a Parquet file. The file only
+    appears under its final name once every chunk has been written.
+    Input: iterable of pd.DataFrame, path
+    Output: generator of the same pd.DataFrame chunks
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    with pq.ParquetWriter(tmp, CONTRACT_SCHEMA, compression='zstd') as writer:
+        for chunk in chunks:
+            rows = chunk[CONTRACT_SCHEMA.names].copy()
+            for col in col_list:
+                rows[col] = rows[col].astype(object).where(rows[col].notna(), None)
+            writer.write_table(pa.Table.from_pandas(rows, schema=CONTRACT_SCHEMA, preserve_index=False))
+            yield chunk
+    os.replace(tmp, path)
+
+def write_groups(partials, contracts_dir=CONTRACTS_DIR):
+    """
+    This function stores every group of every dimension, agency and fiscal year next to the contract rows, so the
+    query engine can answer single-dimension questions without scanning contracts. Groups are ranked within their
+    dimension, agency and fiscal year by each measure, largest first and ties by name, and carry the total of
+    themselves and every group ranked below them, so a top n with everything else as "OTHER" reads n + 1 rows.
+    Input: dict of (agency code, fiscal year) -> dict of dimension -> pd.DataFrame, contracts folder
+    Output: None
+    """
+    frames = []
+    for (agency, year), dims in partials.items():
+        for col, agg in dims.items():
+            part = agg.rename_axis('group').reset_index()
+            part.insert(0, 'dimension', col)
+            part['agency'] = agency
+            part['fiscal_year'] = year
+            frames.append(part)
+    groups = pd.concat(frames, ignore_index=True)
+
+    keys = ['dimension', 'agency', 'fiscal_year']
+    for measure, value in [('count', 'count'), ('sum', AMOUNT)]:
+        groups = groups.sort_values(keys + [value, 'group'], ascending=[True, True, True, False, True], ignore_index=True)
+        groups[f'rank_{measure}'] = groups.groupby(keys, sort=False).cumcount() + 1
+        groups[f'rest_{measure}'] = groups[::-1].groupby(keys, sort=False)[value].cumsum()[::-1]
+
+    path = Path(contracts_dir) / 'groups.parquet'
+    tmp = path.with_suffix('.tmp')
+    groups.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+
+def aggregate_file(path, chunksize=500000, contracts_dir=None, partial_dir=PARTIAL_DIR):
+    """
+    This function reads one raw fiscal year file or archive once, aggregates every dimension and stores the result
+    in its own partition of the partials folder. If a contracts folder is given, the contract rows are written
+    there as Parquet in the same pass.
+    Input: path, number of rows per chunk, contracts folder (optional), partials folder
+    Output: agency code (string), fiscal year (int)
+    """
+    agency, year = agency_code(path), fiscal_year(path)
+    chunks = iter_chunks(path, [AMOUNT] + col_list, chunksize)
+    if contracts_dir is not None:
+        chunks = write_contracts(chunks, contracts_path(agency, year, contracts_dir))
+    save_partial(agency, year, aggregate_chunks(chunks), partial_dir)
+    return agency, year
+
+def top_n(agg, col, measure, year, n=TOP_N):
+    """
+    This function keeps the n largest groups of one fiscal year and adds everything else together as "OTHER".
+    Input: aggregate for one dimension (pd.DataFrame), dimension, measure column, fiscal year, n
+    Output: pd.DataFrame with columns [col, measure, fiscal_year]
+    """
+    sub = agg[[measure]].rename_axis(col).reset_index()
+    # Break ties by name so the cut doesn't depend on the order groups were read in
+    sub = sub.sort_values([measure, col], ascending=[False, True]).reset_index(drop=True)
+    sub['fiscal_year'] = year
+
+    if len(sub) > n and col not in keep_all:
+        # Add together groups with smaller totals as "Other"
+        other_sum = sub[measure][n:].sum()
+        sub = sub[:n].copy()
+        sub.loc[len(sub)] = ['OTHER', other_sum, year]
+        sub = sub.sort_values(measure, ascending=True).reset_index(drop=True)
+
+    return sub
+
+def build_tables(partials):
+    """
+    This function turns the per-year aggregates into the Plot Data tables.
+    Input: dict of fiscal year -> dict of dimension -> pd.DataFrame
+    Output: dict of table name -> pd.DataFrame
+    """
+    tables = {}
+    years = sorted(partials)
+    for col in col_list:
+        tables[col] = pd.concat([top_n(partials[yr][col], col, AMOUNT, yr) for yr in years], ignore_index=True)
+    for col in count_list:
+        tables[f'{col}_count'] = pd.concat([top_n(partials[yr][col], col, 'count', yr) for yr in years], ignore_index=True)
+    return tables
+
+def write_tables(tables, out_dir=OUT_DIR):
+    """
+    This function writes the Plot Data tables to CSV.
+    Input: dict of table name -> pd.DataFrame, folder
+    Output: None
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for name, df in tables.items():
+        df.to_csv(out_dir / f'{name}.csv', index=False)
+
+def table_names():
+    """
+    This function lists the Plot Data tables written for every agency, including the search index.
+    Input: None
+    Output: list of table names
+    """
+    return col_list + [f'{col}_count' for col in count_list] + SEARCH_TABLES
+
+def write_agencies(out_dir=OUT_DIR):
+    """
+    This function lists the agencies that have Plot Data tables, for the app's agency picker.
+    Input: Plot Data folder
+    Output: pd.DataFrame with agency and code columns
+    """
+    found = {path.name.split('=')[1] for path in Path(out_dir).glob('agency=*') if any(path.glob('*.csv'))}
+    df = pd.DataFrame([(name, code) for code, name in names.items() if code in found], columns=['agency', 'code'])
+    df.to_csv(Path(out_dir) / 'agencies.csv', index=False)
+    return df
+
+def file_digest(path):
+    """
+    This function hashes the contents of a file in blocks.
+    Input: path
+    Output: hex digest (string)
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def load_manifest(partial_dir=PARTIAL_DIR):
+    """
+    This function reads the manifest of raw files that have already been aggregated.
+    Input: partials folder
+    Output: dict of file name -> {sha256, size, mtime, agency, fiscal_year}
+    """
+    path = Path(partial_dir) / 'manifest.json'
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(manifest, partial_dir=PARTIAL_DIR):
+    """
+    This function writes the manifest of aggregated raw files, replacing the old one atomically.
+    Input: manifest (dict), partials folder
+    Output: None
+    """
+    path = Path(partial_dir) / 'manifest.json'
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+def file_entry(path, old=None):
+    """
+    This function describes a raw file for the manifest. The content hash is only recomputed when the size or
+    modification time differ from the previous entry.
+    Input: path, previous manifest entry (optional)
+    Output: dict with sha256, size, mtime, agency and fiscal_year
+    """
+    stat = Path(path).stat()
+    entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'agency': agency_code(path), 'fiscal_year': fiscal_year(path)}
+    if old and old.get('size') == entry['size'] and old.get('mtime') == entry['mtime']:
+        entry['sha256'] = old['sha256']
+    else:
+        entry['sha256'] = file_digest(path)
+    return entry
+
+def partial_path(agency, year, partial_dir=PARTIAL_DIR):
+    """
+    This function returns where the aggregates of one agency and fiscal year are stored.
+    Input: agency code, fiscal year, partials folder
+    Output: path
+    """
+    return partition(partial_dir, agency) / f'FY{year}.parquet'
+
+def save_partial(agency, year, partials, partial_dir=PARTIAL_DIR):
+    """
+    This function stores the aggregates of one agency and fiscal year in long format. The file only appears under
+    its final name once it is complete, since workers write their partitions at the same time.
+    Input: agency code, fiscal year, dict of dimension -> pd.DataFrame, partials folder
+    Output: None
+    """
+    frames = []
+    for col, agg in partials.items():
+        part = agg.rename_axis('group').reset_index()
+        part.insert(0, 'dimension', col)
+        frames.append(part)
+    path = partial_path(agency, year, partial_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    pd.concat(frames, ignore_index=True).to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+
+def load_partial(agency, year, partial_dir=PARTIAL_DIR):
+    """
+    This function reads the stored aggregates of one agency and fiscal year.
+    Input: agency code, fiscal year, partials folder
+    Output: dict of dimension -> pd.DataFrame, with every dimension in col_list
+    """
+    df = pd.read_parquet(partial_path(agency, year, partial_dir))
+    groups = {col: part.set_index('group')[[AMOUNT, 'count']].rename_axis(None)
+              for col, part in df.groupby('dimension', sort=False)}
+    # Dimensions left blank by an agency (like the DoD claimant program for civilian agencies) have no rows
+    empty = pd.DataFrame({AMOUNT: pd.Series(dtype='float64'), 'count': pd.Series(dtype='int64')})
+    return {col: groups.get(col, empty) for col in col_list}
+
+def remove_stale(folder, pattern, keep, key):
+    """
+    This function deletes the partitions of a dataset that no longer have a raw file, including any left from
+    before the data was partitioned by agency.
+    Input: dataset folder, glob pattern of partitions below agency=<code>, set of (agency, fiscal year) to keep,
+           function reading the fiscal year from a partition path
+    Output: set of agencies that lost a partition
+    """
+    folder, changed = Path(folder), set()
+    for path in folder.glob(pattern):
+        path.unlink() if path.is_file() else shutil.rmtree(path)
+    for path in folder.glob(f'agency=*/{pattern}'):
+        agency = path.parent.name.split('=')[1]
+        if (agency, key(path)) not in keep:
+            path.unlink() if path.is_file() else shutil.rmtree(path)
+            changed.add(agency)
+    return changed
+
+def run(raw_dir=RAW_DIR, out_dir=OUT_DIR, partial_dir=PARTIAL_DIR, workers=None, chunksize=500000, full=False,
+        contracts_dir=None):
+    """
+    This function aggregates every new or changed raw file in parallel, one agency and fiscal year per task, and
+    rebuilds the Plot Data tables of every agency that changed from its stored partials.
+    Input: raw folder, output folder, partials folder, number of worker processes, rows per chunk,
+           whether to ignore the manifest and reprocess everything, folder for contract rows (optional)
+    Output: dict of agency code -> dict of table name -> pd.DataFrame, for the agencies that were rebuilt
+    """
+    paths = find_files(raw_dir)
+    if not paths:
+        raise FileNotFoundError(f'No FY* files found in {raw_dir}')
+
+    partial_dir = Path(partial_dir)
+    partial_dir.mkdir(parents=True, exist_ok=True)
+    old = {} if full else load_manifest(partial_dir)
+
+    manifest = {p.name: file_entry(p, old.get(p.name)) for p in paths}
+    key = {p: (manifest[p.name]['agency'], manifest[p.name]['fiscal_year']) for p in paths}
+    stale = [p for p in paths
+             if old.get(p.name, {}).get('sha256') != manifest[p.name]['sha256']
+             or not partial_path(*key[p], partial_dir).exists()
+             or (contracts_dir is not None and not contracts_path(*key[p], contracts_dir).exists())]
+    print(f'{len(stale)} of {len(paths)} agency fiscal years need to be aggregated', file=sys.stderr) # Progress, not output
+
+    if stale:
+        # Largest files first, so a big agency year doesn't start last and hold up the whole run
+        stale = sorted(stale, key=lambda p: manifest[p.name]['size'], reverse=True)
+        n = len(stale)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(aggregate_file, stale, [chunksize] * n, [contracts_dir] * n, [partial_dir] * n))
+
+    # Forget agency fiscal years whose raw file is gone
+    keep = set(key.values())
+    changed = {key[p][0] for p in stale}
+    changed |= remove_stale(partial_dir, 'FY*.parquet', keep, fiscal_year)
+    if contracts_dir is not None:
+        remove_stale(contracts_dir, 'fiscal_year=*', keep, lambda path: int(path.name.split('=')[1]))
+    save_manifest(manifest, partial_dir)
+
+    agencies = sorted({agency for agency, _ in keep})
+    changed |= {agency for agency in agencies if not all((partition(out_dir, agency) / f'{name}.csv').exists()
+                                                         for name in table_names())}
+    tables = {}
+    for agency in sorted(changed):
+        out = partition(out_dir, agency)
+        if agency not in agencies: # No raw files left for this agency
+            for name in table_names():
+                (out / f'{name}.csv').unlink(missing_ok=True)
+            continue
+        years = sorted(year for a, year in keep if a == agency)
+        partials = {yr: load_partial(agency, yr, partial_dir) for yr in years}
+        tables[agency] = {**build_tables(partials), **build_index(partials)}
+        write_tables(tables[agency], out)
+    write_agencies(out_dir)
+
+    if contracts_dir is not None:
+        write_groups({(agency, yr): load_partial(agency, yr, partial_dir) for agency, yr in keep}, contracts_dir)
+    return tables
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Aggregate raw service contract files into Plot Data tables.')
+    parser.add_argument('--raw-dir', default=RAW_DIR, help='folder containing FY*.csv or FY*.zip files')
+    parser.add_argument('--out-dir', default=OUT_DIR, help='folder to write Plot Data CSVs to')
+    parser.add_argument('--partial-dir', default=PARTIAL_DIR, help='folder for per-year aggregates and the manifest')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--chunksize', type=int, default=500000, help='rows read per chunk')
+    parser.add_argument('--full', action='store_true', help='ignore the manifest and reprocess every fiscal year')
+    parser.add_argument('--contracts-dir', nargs='?', const=CONTRACTS_DIR, help=f'also write contract rows as Parquet for the query engine (default folder {CONTRACTS_DIR})')
+    parser.add_argument('--bundle', action='store_true', help='rebuild the app data bundle afterwards')
+    args = parser.parse_args()
+
+    tables = run(args.raw_dir, args.out_dir, args.partial_dir, args.workers, args.chunksize, args.full, args.contracts_dir)
+    for agency, agency_tables in tables.items():
+        print(f'Wrote {len(agency_tables)} tables for {names[agency]} to {partition(args.out_dir, agency)}')
+
+    if args.bundle:
+        from build_bundle import build_bundle
+        print(build_bundle(args.out_dir))
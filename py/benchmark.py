@@ -0,0 +1,306 @@
+"""
+Benchmark the data pipeline and the app's hot paths on synthetic data, fully offline.
+
+Synthetic fiscal year files shaped like the FPDS service contract downloads (same columns, skewed label
+frequencies, deobligations and missing values) are generated at every requested scale, 1x being --rows contracts
+per fiscal year. For each scale these stages are timed:
+    aggregate      - cleaning and aggregation of the raw files into the Plot Data tables (py/aggregate.py)
+    geocode_join   - geocoding of every contract from ZIP5 centroids into an empty cache and the join of the
+                     coordinates onto the contracts (py/geocode.py), then the same join with a warm cache
+    map_bins       - binning of the geocoded contracts for the map (py/build_map_bins.py)
+    bundle         - build of the app data bundle (py/build_bundle.py)
+    load           - get_data for every table with a cold cache, and get_geo
+    figures        - every tab's figure built without the figure cache, human_format over the hover columns, and
+                     a render of the contract map through st.map
+    search         - loading of the search index, and type-ahead lookups with the per-year totals of the best match
+
+Every stage is repeated and the median is reported. Results are printed as JSON, together with the machine and
+commit they were measured on, so runs can be compared over time. Only the results go to stdout; progress messages
+go to stderr, so the output can be redirected to a file.
+
+Usage: python py/benchmark.py [--scales 1 10 100] [--rows N] [--years N] [--repeat N] [--workers N] [--out FILE]
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import aggregate
+import build_map_bins
+import geocode
+from agencies import DEFAULT_AGENCY, names, partition
+from build_bundle import build_bundle
+
+REPO = Path(__file__).resolve().parent.parent
+APP_DIR = REPO / 'myenv'
+PLOT_DIR = REPO / 'Clean Data' / 'Plot Data'
+
+# Tables the pipeline does not produce from contract files, copied from the repo as they are
+STATIC_TABLES = ['compare_agencies', 'compare_all_spending', 'states']
+
+# Number of distinct values of each label at 1x; recipients and offices grow with the number of contracts
+CARDINALITY = {'awarding_sub_agency_name': 12,
+               'awarding_office_name': 400,
+               'recipient_name': 2000,
+               'product_or_service_code_description': 600,
+               'dod_claimant_program_description': 40,
+               'type_of_contract_pricing': 12,
+               'award_type': 4,
+               'contract_bundling': 6,
+               'solicitation_procedures': 10,
+               'naics_description': 300,
+               'city': 3000}
+GROWING = ['awarding_office_name', 'recipient_name', 'city']
+
+#### Functions
+
+def labels(rng, name, n, rows, scale):
+    """
+    This function draws label values with a Zipf-like skew, so a few values cover most contracts like in FPDS.
+    Input: random generator, label name, number of distinct values at 1x, number of rows, scale
+    Output: np.ndarray of strings
+    """
+    if name in GROWING:
+        n = int(n * np.sqrt(scale))
+    weights = 1 / np.arange(1, n + 1) ** 1.1
+    idx = rng.choice(n, size=rows, p=weights / weights.sum())
+    names = np.array([f'{name.upper().replace("_", " ")} {i:06d}' for i in range(n)], dtype=object)
+    return names[idx]
+
+def synthetic_year(rng, rows, scale, states):
+    """
+    This function generates one fiscal year of contracts with the columns read by the pipeline.
+    Input: random generator, number of rows, scale, list of state codes
+    Output: pd.DataFrame
+    """
+    df = pd.DataFrame({col: labels(rng, col, CARDINALITY[col], rows, scale) for col in aggregate.col_list
+                       if col in CARDINALITY})
+    df.insert(0, 'contract_award_unique_key', [f'CONT_AWD_{i:09d}' for i in rng.permutation(rows)])
+    amount = np.round(rng.lognormal(10, 2.5, rows), 2)
+    df.insert(1, aggregate.AMOUNT, np.where(rng.random(rows) < 0.05, -amount / 10, amount)) # Some deobligations
+    df['primary_place_of_performance_state_code'] = rng.choice(states, size=rows)
+    df['product_or_service_code'] = df['product_or_service_code_description'].str[-4:]
+
+    # Every city has its own ZIP code, stored as ZIP+4 numbers like in the downloads
+    city = labels(rng, 'city', CARDINALITY['city'], rows, scale)
+    df[geocode.CITY] = city
+    df[geocode.ZIP] = pd.Series(city).str[-5:].astype(int) * 10000 + rng.integers(0, 10000, rows)
+
+    # A small share of missing labels, as in the raw files
+    for col in ['recipient_name', 'awarding_office_name', 'naics_description', geocode.CITY]:
+        df.loc[rng.random(rows) < 0.01, col] = np.nan
+    return df
+
+def generate(raw_dir, rows, years, scale, seed=0):
+    """
+    This function writes synthetic raw fiscal year files, plus a ZIP5 centroid table covering most of their ZIPs.
+    Input: raw folder, rows per fiscal year at 1x, number of fiscal years, scale, random seed
+    Output: number of contracts written, dict of zip5 -> (lat, lon)
+    """
+    rng = np.random.default_rng(seed)
+    raw_dir.mkdir(parents=True, exist_ok=True)
+    states = pd.read_csv(PLOT_DIR / 'states.csv')['State'].tolist()
+    total = 0
+    for year in range(2023 - years, 2023):
+        df = synthetic_year(rng, rows * scale, scale, states)
+        df.to_csv(raw_dir / f'FY{year}_{DEFAULT_AGENCY}_synthetic.csv', index=False)
+        total += len(df)
+
+    n = int(CARDINALITY['city'] * np.sqrt(scale))
+    zips = [f'{i:05d}' for i in range(n) if rng.random() < 0.95] # The rest cannot be located offline
+    centroids = {z: (round(rng.uniform(25, 49), 5), round(rng.uniform(-124, -67), 5)) for z in zips}
+    return total, centroids
+
+def timed(func, repeat, setup=None):
+    """
+    This function times a function over several runs.
+    Input: function, number of runs, function to call untimed before each run (optional)
+    Output: dict with the median and fastest run in seconds, and every run
+    """
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - start)
+    return {'seconds': round(statistics.median(runs), 4), 'min': round(min(runs), 4), 'runs': [round(r, 4) for r in runs]}
+
+def bench_pipeline(work, repeat, workers, centroids):
+    """
+    This function times aggregation, geocoding and map binning of the synthetic raw files and builds the bundle.
+    Input: scale folder, number of runs, worker processes, ZIP5 centroids
+    Output: dict of stage -> timings
+    """
+    raw_dir, plot_dir = work / 'raw', work / 'plot'
+    plot_dir.mkdir(exist_ok=True)
+    results = {}
+    results['aggregate'] = timed(lambda: aggregate.run(raw_dir, plot_dir, work / 'partials', workers, full=True,
+                                                       contracts_dir=work / 'contracts'), repeat)
+    for name in STATIC_TABLES:
+        shutil.copy2(PLOT_DIR / f'{name}.csv', plot_dir)
+
+    usecols = geocode.KEEP_COLS + [geocode.CITY, geocode.STATE, geocode.ZIP]
+    raw = pd.concat([pd.read_csv(path, usecols=usecols, low_memory=False).assign(fiscal_year=aggregate.fiscal_year(path))
+                     for path in aggregate.find_files(raw_dir)], ignore_index=True)
+    cache_path = work / 'coordinates.sqlite'
+    coords = {}
+
+    def join():
+        cache = geocode.GeocodeCache(cache_path)
+        coords['df'] = geocode.geocode_contracts(raw, cache, centroids)
+        cache.close()
+
+    results['geocode_join'] = timed(join, repeat, setup=lambda: cache_path.unlink(missing_ok=True))
+    results['geocode_join_cached'] = timed(join, repeat)
+
+    def bins():
+        out = partition(plot_dir, DEFAULT_AGENCY)
+        build_map_bins.build_bins(coords['df']).to_csv(out / 'map_bins.csv', index=False)
+        build_map_bins.build_top_psc(coords['df']).to_csv(out / 'map_top_psc.csv', index=False)
+
+    results['map_bins'] = timed(bins, repeat)
+    results['bundle'] = timed(lambda: build_bundle(plot_dir, work / 'bundle'), repeat)
+    return results
+
+def bench_app(work, repeat):
+    """
+    This function times the app's loaders and figure functions against the bundle of one scale. Figures are built
+    from already loaded tables and without the figure cache, so only their construction is measured.
+    Input: scale folder, number of runs
+    Output: dict of stage -> timings
+    """
+    import databundle
+    import dodcontractapp as app
+    import mapbins
+    import query
+    import search
+
+    databundle.BUNDLE_ROOT = work / 'bundle'
+    query.CONTRACTS_DIR = work / 'contracts'
+    query.reset()
+    results = {}
+
+    for name in databundle.read_manifest()['tables']:
+        results[f'get_data:{name}'] = timed(lambda: app.get_data(name), repeat, setup=databundle.invalidate)
+    agency = names[DEFAULT_AGENCY]
+    states = app.get_data('primary_place_of_performance_state_code', agency).rename(
+        columns={'primary_place_of_performance_state_code': 'State'})
+    results['get_geo'] = timed(lambda: app.get_geo(states), repeat)
+
+    year = int(app.get_data('recipient_name', agency)['fiscal_year'].max())
+    agency2 = sorted(set(app.get_data('compare_agencies')['agency']) - {agency})[0]
+    figures = {'tab2:spending_fig': lambda: app.spending_fig.__wrapped__(agency, agency2),
+               'tab2:total_fig': lambda: app.total_fig.__wrapped__(agency, agency2),
+               'tab5:state_map_fig': lambda: app.state_map_fig.__wrapped__(agency, year),
+               'tab5:map_bins': lambda: mapbins.map_bins(DEFAULT_AGENCY, year)}
+    for view in app.sub_col_names:
+        for mode in ['Dollar Value', 'Number of Contracts']:
+            figures[f'tab3:breakdown_fig:{view}:{mode}'] = lambda view=view, mode=mode: app.breakdown_fig.__wrapped__(agency, view, mode)
+        figures[f'tab3:breakdown_fig:{view}:query'] = lambda view=view: app.breakdown_fig.__wrapped__(
+            agency, view, 'Dollar Value', (year - 2, year), 10, query.version())
+    for category in app.categories:
+        figures[f'tab4:category_fig:{category}'] = lambda category=category: app.category_fig.__wrapped__(agency, category, year)
+    for name, func in figures.items():
+        func() # Loads the data, and for the query engine its tables, outside of the timed runs
+        results[name] = timed(func, repeat)
+
+    # The contract map rendered for real, so st.map has to serialize the bins
+    def render_map():
+        from streamlit.testing.v1 import AppTest
+
+        at = AppTest.from_string(f'import dodcontractapp as app\napp.contract_map({agency!r}, {year})\n',
+                                 default_timeout=120).run()
+        if at.exception:
+            raise RuntimeError(f'contract_map raised: {at.exception[0].message}')
+        if not at.get('deck_gl_json_chart'):
+            raise RuntimeError('contract_map drew no map')
+
+    results['tab5:contract_map'] = timed(render_map, repeat)
+
+    # human_format over the full hover columns, as done when building hover labels
+    hover = {('compare_agencies', None): 'spending', **{(col, agency): aggregate.AMOUNT for col in app.categories.values()}}
+    for (name, agency_name), col in hover.items():
+        values = app.get_data(name, agency_name)[col]
+        results[f"human_format:{name}"] = timed(lambda: app.human_format_array(values), repeat)
+
+    # Type-ahead lookups, from the first keystroke to a full name with a typo
+    def lookup(text):
+        matches = search.search(DEFAULT_AGENCY, text)
+        return search.totals(DEFAULT_AGENCY, matches[0][0]) if matches else None
+
+    results['search:index'] = timed(lambda: search.available(DEFAULT_AGENCY), repeat, setup=databundle.invalidate)
+    for text in ['r', 'recipient name 00', 'name 000001', 'recipeint name 000001']:
+        results[f'search:{text}'] = timed(lambda text=text: lookup(text), repeat)
+    return results
+
+def git_commit():
+    """
+    This function returns the commit the benchmark runs on, if the repo is a git checkout.
+    Input: None
+    Output: commit hash (string) or None
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(scales, rows, years, repeat, workers, workdir):
+    """
+    This function generates the synthetic data for every scale and runs every benchmark on it.
+    Input: list of scales, rows per fiscal year at 1x, number of fiscal years, runs per stage, worker processes,
+           folder for the synthetic data
+    Output: results (dict)
+    """
+    results = {'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+               'commit': git_commit(),
+               'python': platform.python_version(),
+               'machine': {'platform': platform.platform(), 'cpus': os.cpu_count()},
+               'params': {'rows': rows, 'years': years, 'repeat': repeat, 'workers': workers},
+               'scales': {}}
+    for scale in scales:
+        work = Path(workdir) / f'x{scale}'
+        shutil.rmtree(work, ignore_errors=True)
+        contracts, centroids = generate(work / 'raw', rows, years, scale)
+        stages = bench_pipeline(work, repeat, workers, centroids)
+        stages.update(bench_app(work, repeat))
+        results['scales'][f'{scale}x'] = {'contracts': contracts, 'stages': stages}
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the data pipeline and app on synthetic data.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100], help='multiples of --rows to run')
+    parser.add_argument('--rows', type=int, default=10000, help='contracts per fiscal year at 1x')
+    parser.add_argument('--years', type=int, default=3, help='number of fiscal years to generate')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage (median is reported)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='worker processes for the aggregation')
+    parser.add_argument('--workdir', help='folder to keep the synthetic data in (a temporary folder by default)')
+    parser.add_argument('--out', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    sys.path.insert(0, str(APP_DIR))
+    workdir = args.workdir or tempfile.mkdtemp(prefix='dodapp-bench-')
+    try:
+        # Keep stdout for the results
+        with contextlib.redirect_stdout(sys.stderr):
+            results = run(args.scales, args.rows, args.years, args.repeat, args.workers, workdir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,205 @@
+"""
+Build the local data bundle that the app reads instead of downloading Plot Data CSVs.
+
+Every CSV in Clean Data/Plot Data, and in its agency=<code> partitions, becomes one uncompressed Arrow IPC (Feather v2) file with fixed dtypes,
+so the app can memory-map it. Numbers get the narrowest type that holds them, and text labels are dictionary
+encoded with one dictionary per kind of label, shared by every table that has it, so the app can hold each
+distinct name once however many tables it is loaded from. Each build is written to its own version folder named after a hash of the
+input files, and the CURRENT pointer is swapped only once the whole folder is in place.
+
+Usage: python py/build_bundle.py [--plot-dir DIR] [--bundle-dir DIR] [--prune]
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+
+REPO = Path(__file__).resolve().parent.parent
+PLOT_DIR = REPO / 'Clean Data' / 'Plot Data'
+BUNDLE_DIR = REPO / 'Clean Data' / 'Bundle'
+
+# Bumped whenever the layout of the bundle changes, so the new layout gets a new version
+FORMAT = 2
+
+# Column types shared by all plot tables; any other column is a text label
+NUMERIC_TYPES = {'total_obligated_amount': pa.float64(), # Amounts keep full precision, they are shown as is
+                 'spending': pa.float64(),
+                 'Obligations': pa.float64(),
+                 'lat': pa.float32(),
+                 'lon': pa.float32(),
+                 'long': pa.float32(), # Longitude in the Geocoding notebook's data_coordinates.csv
+                 'fiscal_year': pa.int16(),
+                 'Fiscal Year': pa.int16(),
+                 'count': pa.int32(),
+                 'rank': pa.int16(),
+                 'precision': pa.int8(),
+                 'id': pa.int32(),
+                 'trigram': pa.uint16()}
+
+# Label columns that hold the same kind of values under different names; any other label is its own kind
+DOMAINS = {'agency': 'agency',
+           'Agency': 'agency',
+           'State': 'primary_place_of_performance_state_code'}
+
+#### Functions
+
+def domain(col):
+    """
+    This function names the kind of label a column holds, which decides the dictionary it is encoded with.
+    Input: column name
+    Output: domain name (string)
+    """
+    return DOMAINS.get(col, col)
+
+def read_csv(path):
+    """
+    This function reads a Plot Data CSV with every label column as text, so codes like 097 keep their leading zeros
+    and names like NA are not taken for missing values.
+    Input: path
+    Output: pd.DataFrame
+    """
+    cols = pd.read_csv(path, nrows=0).columns
+    return pd.read_csv(path, dtype={col: str for col in cols if col not in NUMERIC_TYPES},
+                       keep_default_na=False, na_values=[''])
+
+def build_dictionaries(frames):
+    """
+    This function collects the sorted distinct values of every kind of label across all plot tables.
+    Input: dict of table name -> pd.DataFrame
+    Output: dict of domain -> pa.Array of strings
+    """
+    values = {}
+    for df in frames.values():
+        for col in df.columns:
+            if col not in NUMERIC_TYPES:
+                values.setdefault(domain(col), set()).update(df[col].dropna())
+    return {name: pa.array(sorted(vals), pa.string()) for name, vals in values.items()}
+
+def to_arrow(df, dictionaries):
+    """
+    This function converts a plot table to an Arrow table with fixed dtypes, encoding labels with the shared
+    dictionary of their domain. The domain is kept in the field metadata for the app to find the dictionary.
+    Input: df (pd.DataFrame), dict of domain -> pa.Array
+    Output: pa.Table
+    """
+    fields, arrays = [], []
+    for col in df.columns:
+        if col in NUMERIC_TYPES:
+            fields.append(pa.field(col, NUMERIC_TYPES[col]))
+            arrays.append(pa.array(df[col], NUMERIC_TYPES[col], from_pandas=True))
+        else:
+            dictionary = dictionaries[domain(col)]
+            labels = pa.array(df[col].astype(object).where(df[col].notna(), None), pa.string())
+            indices = pc.index_in(labels, value_set=dictionary).cast(pa.int32())
+            fields.append(pa.field(col, pa.dictionary(pa.int32(), pa.string()), metadata={'domain': domain(col)}))
+            arrays.append(pa.DictionaryArray.from_arrays(indices, dictionary))
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+def memory_bytes(table):
+    """
+    This function estimates how much memory a table takes once loaded by the app, without its shared dictionaries.
+    Input: pa.Table
+    Output: bytes (int)
+    """
+    return sum(col.indices.nbytes if pa.types.is_dictionary(col.type) else col.nbytes
+               for col in (table.column(i).combine_chunks() for i in range(table.num_columns)))
+
+def table_name(path, plot_dir):
+    """
+    This function names the table stored from a Plot Data CSV after its path, like agency=097/recipient_name.
+    Input: path, Plot Data folder
+    Output: table name (string)
+    """
+    return path.relative_to(plot_dir).with_suffix('').as_posix()
+
+def hash_files(paths, plot_dir):
+    """
+    This function hashes the contents of a list of files, used as the version of a bundle.
+    Input: paths (list of Path), Plot Data folder they are in
+    Output: short hex digest (string)
+    """
+    h = hashlib.sha256(f'format {FORMAT}'.encode())
+    for path in sorted(paths):
+        h.update(table_name(path, plot_dir).encode())
+        h.update(path.read_bytes())
+    return h.hexdigest()[:12]
+
+def publish(bundle_dir, version):
+    """
+    This function points the CURRENT file at a bundle version. The pointer is replaced atomically, so a running app
+    never sees a half-written bundle.
+    Input: bundle folder, version (string)
+    Output: None
+    """
+    tmp = bundle_dir / 'CURRENT.tmp'
+    tmp.write_text(version + '\n')
+    os.replace(tmp, bundle_dir / 'CURRENT')
+
+def prune(bundle_dir, keep):
+    """
+    This function deletes every bundle version except the one given.
+    Input: bundle folder, version to keep
+    Output: list of deleted versions
+    """
+    removed = []
+    for path in Path(bundle_dir).iterdir():
+        if path.is_dir() and path.name != keep:
+            shutil.rmtree(path)
+            removed.append(path.name)
+    return removed
+
+def build_bundle(plot_dir=PLOT_DIR, bundle_dir=BUNDLE_DIR):
+    """
+    This function writes every Plot Data CSV, including the agency partitions, into a new bundle version and
+    publishes it.
+    Input: folder of Plot Data CSVs, bundle folder
+    Output: version (string)
+    """
+    plot_dir, bundle_dir = Path(plot_dir), Path(bundle_dir)
+    paths = sorted(plot_dir.glob('*.csv')) + sorted(plot_dir.glob('agency=*/*.csv'))
+    version = hash_files(paths, plot_dir)
+    out = bundle_dir / version
+    out.mkdir(parents=True, exist_ok=True)
+
+    frames = {table_name(path, plot_dir): read_csv(path) for path in paths}
+    dictionaries = build_dictionaries(frames)
+
+    manifest = {'version': version, 'format': FORMAT, 'tables': {},
+                'dictionaries': {name: {'values': len(d), 'bytes': d.nbytes} for name, d in dictionaries.items()}}
+    for name, df in frames.items():
+        table = to_arrow(df, dictionaries)
+        (out / name).parent.mkdir(parents=True, exist_ok=True)
+        # Uncompressed so the file can be memory-mapped without a copy
+        feather.write_feather(table, out / f'{name}.arrow', compression='uncompressed')
+        manifest['tables'][name] = {'rows': table.num_rows, 'columns': table.schema.names, 'bytes': memory_bytes(table)}
+
+    with open(out / 'manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    publish(bundle_dir, version)
+    return version
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the local Plot Data bundle for the app.')
+    parser.add_argument('--plot-dir', default=PLOT_DIR, help='folder of Plot Data CSVs')
+    parser.add_argument('--bundle-dir', default=BUNDLE_DIR, help='folder to write bundle versions to')
+    parser.add_argument('--prune', action='store_true', help='delete all other bundle versions afterwards')
+    args = parser.parse_args()
+    version = build_bundle(args.plot_dir, args.bundle_dir)
+    print(version)
+    with open(Path(args.bundle_dir) / version / 'manifest.json') as f:
+        manifest = json.load(f)
+    for name, table in manifest['tables'].items():
+        print(f'{name}: {table["rows"]} rows, {table["bytes"]:,} bytes')
+    shared = sum(d['bytes'] for d in manifest['dictionaries'].values())
+    print(f'Shared label dictionaries: {shared:,} bytes')
+    if args.prune:
+        for old in prune(args.bundle_dir, version):
+            print(f'Removed {old}')
@@ -0,0 +1,128 @@
+"""
+Build the spatial index behind the contract location map.
+
+Geocoded contracts are binned into geohash cells at several precisions, separately for every fiscal year and PSC
+(plus an "ALL" partition across PSCs). Each bin keeps the mean location of its contracts, the number of contracts
+and their total obligations, so the app can send the browser a bounded number of bins instead of every contract.
+The top PSCs per fiscal year for the map filter are computed here as well. Both are written per agency, to the
+agency=<code> partitions of Plot Data. Coordinates can come from py/geocode.py or from the Geocoding notebook, whose
+data_coordinates.csv covers a single fiscal year of DoD contracts and names longitude "long".
+
+Usage: python py/build_map_bins.py [--coords FILE] [--fiscal-year YYYY] [--out-dir DIR] [--bundle]
+"""
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from agencies import DEFAULT_AGENCY, partition
+
+REPO = Path(__file__).resolve().parent.parent
+COORDS_PATH = REPO / 'Clean Data' / 'data_coordinates.csv'
+OUT_DIR = REPO / 'Clean Data' / 'Plot Data'
+
+PSC = 'product_or_service_code_description'
+ALL = 'ALL'
+
+# Geohash precisions to build, from roughly 600 km down to 5 km cells
+PRECISIONS = [2, 3, 4, 5]
+
+# Fiscal year of coordinates files without a fiscal_year column, like the notebook's FY2022 data_coordinates.csv
+LEGACY_YEAR = 2022
+
+BASE32 = np.array(list('0123456789bcdefghjkmnpqrstuvwxyz'))
+
+#### Functions
+
+def geohash(lat, lon, precision):
+    """
+    This function encodes coordinates as geohash strings.
+    Input: latitudes and longitudes (array-like), number of characters
+    Output: np.ndarray of geohash strings
+    """
+    nbits = precision * 5
+    lon_bits, lat_bits = (nbits + 1) // 2, nbits // 2
+    lat_i = np.clip(((np.asarray(lat) + 90) / 180 * (1 << lat_bits)).astype(np.int64), 0, (1 << lat_bits) - 1)
+    lon_i = np.clip(((np.asarray(lon) + 180) / 360 * (1 << lon_bits)).astype(np.int64), 0, (1 << lon_bits) - 1)
+
+    # Interleave the bits, longitude first
+    code = np.zeros(len(lat_i), dtype=np.int64)
+    for i in range(nbits):
+        if i % 2 == 0:
+            bit = (lon_i >> (lon_bits - 1 - i // 2)) & 1
+        else:
+            bit = (lat_i >> (lat_bits - 1 - i // 2)) & 1
+        code = (code << 1) | bit
+
+    digits = np.stack([(code >> (5 * (precision - 1 - j))) & 31 for j in range(precision)], axis=1)
+    return np.ascontiguousarray(BASE32[digits]).view(f'<U{precision}').ravel()
+
+def build_bins(coords, precisions=PRECISIONS):
+    """
+    This function aggregates geocoded contracts into geohash bins per fiscal year and PSC.
+    Input: df with fiscal_year, product_or_service_code_description, lat, lon and total_obligated_amount columns
+    Output: pd.DataFrame with one row per fiscal year, PSC, precision and bin
+    """
+    coords = coords.dropna(subset=['lat', 'lon'])
+    both = pd.concat([coords, coords.assign(**{PSC: ALL})], ignore_index=True)
+
+    frames = []
+    for precision in precisions:
+        binned = both.assign(precision=precision, geohash=geohash(both['lat'], both['lon'], precision))
+        agg = binned.groupby(['fiscal_year', PSC, 'precision', 'geohash'], sort=True).agg(
+            lat=('lat', 'mean'), lon=('lon', 'mean'), count=('lat', 'size'),
+            total_obligated_amount=('total_obligated_amount', 'sum'))
+        frames.append(agg.reset_index())
+    return pd.concat(frames, ignore_index=True)
+
+def read_coords(path, year=LEGACY_YEAR):
+    """
+    This function reads a file of geocoded contracts with only the columns needed for the map. Files from the
+    Geocoding notebook have no agency or fiscal year and a "long" column, so they are read as DoD contracts of one
+    fiscal year.
+    Input: path, fiscal year of files without a fiscal_year column
+    Output: pd.DataFrame with agency, fiscal_year, product_or_service_code_description, lat, lon and
+            total_obligated_amount columns
+    """
+    cols = ['agency', 'fiscal_year', PSC, 'lat', 'lon', 'long', 'total_obligated_amount']
+    coords = pd.read_csv(path, usecols=lambda col: col in cols, dtype={'agency': str})
+    coords = coords.rename(columns={'long': 'lon'})
+    if 'fiscal_year' not in coords:
+        coords['fiscal_year'] = year
+    if 'agency' not in coords: # Geocoded before the data was partitioned by agency
+        coords['agency'] = DEFAULT_AGENCY
+    return coords
+
+def build_top_psc(coords, n=10):
+    """
+    This function ranks the PSCs with the most contracts in each fiscal year.
+    Input: df of geocoded contracts, number of PSCs to keep per year
+    Output: pd.DataFrame with fiscal_year, PSC, count and rank columns
+    """
+    counts = coords.groupby(['fiscal_year', PSC]).size().rename('count').reset_index()
+    counts = counts.sort_values(['fiscal_year', 'count', PSC], ascending=[True, False, True])
+    counts['rank'] = counts.groupby('fiscal_year').cumcount() + 1
+    return counts[counts['rank'] <= n].reset_index(drop=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the spatial index for the contract location map.')
+    parser.add_argument('--coords', default=COORDS_PATH, help='CSV of geocoded contracts from py/geocode.py or the Geocoding notebook')
+    parser.add_argument('--fiscal-year', type=int, default=LEGACY_YEAR, help='fiscal year of a file without a fiscal_year column')
+    parser.add_argument('--out-dir', default=OUT_DIR, help='folder to write Plot Data CSVs to')
+    parser.add_argument('--bundle', action='store_true', help='rebuild the app data bundle afterwards')
+    args = parser.parse_args()
+
+    cols = ['fiscal_year', PSC, 'lat', 'lon', 'total_obligated_amount']
+    coords = read_coords(args.coords, args.fiscal_year)
+    for agency, part in coords.groupby('agency'):
+        out = partition(args.out_dir, agency)
+        out.mkdir(parents=True, exist_ok=True)
+        bins = build_bins(part[cols])
+        bins.to_csv(out / 'map_bins.csv', index=False)
+        build_top_psc(part[cols]).to_csv(out / 'map_top_psc.csv', index=False)
+        print(f'Wrote {len(bins)} bins for {len(part)} contracts to {out}')
+
+    if args.bundle:
+        from build_bundle import build_bundle
+        print(build_bundle(args.out_dir))
@@ -0,0 +1,37 @@
+"""
+Build the state lookup table used by the map in the app.
+
+The choropleth only needs each state's name next to its postal abbreviation, so the Census TIGER state shapefile
+is reduced to that table once, here, instead of being downloaded and merged on every rerun of the app.
+
+Usage: python py/build_states.py [--shapefile PATH] [--out FILE]
+"""
+import argparse
+from pathlib import Path
+
+import geopandas as gpd
+
+REPO = Path(__file__).resolve().parent.parent
+SHAPEFILE = '/vsicurl/https://github.com/abdelkaderalia/LIHEAPadminapp/raw/main/Data/tl_2021_us_state.shp'
+OUT_PATH = REPO / 'Clean Data' / 'Plot Data' / 'states.csv'
+
+#### Functions
+
+def build_states(shapefile=SHAPEFILE, out=OUT_PATH):
+    """
+    This function reduces the state shapefile to a table of postal abbreviations and names.
+    Input: path or URL of the shapefile, output CSV
+    Output: pd.DataFrame with State and NAME columns
+    """
+    geo = gpd.read_file(shapefile, ignore_geometry=True)
+    states = geo.rename(columns={'STUSPS':'State'})[['State', 'NAME']]
+    states = states.sort_values('State').reset_index(drop=True)
+    states.to_csv(out, index=False)
+    return states
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the state lookup table for the map.')
+    parser.add_argument('--shapefile', default=SHAPEFILE, help='TIGER state shapefile')
+    parser.add_argument('--out', default=OUT_PATH, help='CSV file to write')
+    args = parser.parse_args()
+    print(f'Wrote {len(build_states(args.shapefile, args.out))} states to {args.out}')
@@ -0,0 +1,191 @@
+"""
+Download agency spending data from the USAspending API.
+
+All agencies and fiscal years are requested through one shared aiohttp session. A semaphore bounds the number of
+requests in flight, 429 and 5xx responses are retried with exponential backoff, and every JSON response is cached
+on disk keyed by API root, endpoint and parameters so reruns only hit the API for what is missing. Runs against a
+local stub server therefore never share cached responses with the real API. The current fiscal year is still
+changing, so it is refetched on every run (see --refresh).
+
+Modes:
+    historical - total award obligations per agency and fiscal year (/api/v2/agency/<code>/awards/)
+    category   - obligations per subagency and fiscal year (/api/v2/agency/<code>/sub_agency/)
+
+Usage: python py/fetch_spending.py [--mode historical|category] [--out FILE] [--base-url URL] [--concurrency N] [--refresh YEAR ...]
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+from datetime import date
+from pathlib import Path
+
+import aiohttp
+import pandas as pd
+
+from agencies import codes
+
+REPO = Path(__file__).resolve().parent.parent
+CACHE_DIR = REPO / 'Raw Data' / 'API Cache'
+BASE_URL = 'https://api.usaspending.gov'
+
+ENDPOINTS = {'historical': '/api/v2/agency/{}/awards/',
+             'category': '/api/v2/agency/{}/sub_agency/'}
+
+YEARS = range(2012, 2023)
+
+# Responses worth retrying: rate limiting and server errors
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+#### Functions
+
+class ResponseCache:
+    """
+    On-disk cache of JSON responses, one file per API root, endpoint and set of parameters.
+    """
+
+    def __init__(self, path=CACHE_DIR):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def key(self, base_url, endpoint, params):
+        raw = json.dumps([base_url.rstrip('/'), endpoint, params], sort_keys=True)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, base_url, endpoint, params):
+        path = self.path / f'{self.key(base_url, endpoint, params)}.json'
+        if not path.exists():
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def put(self, base_url, endpoint, params, data):
+        path = self.path / f'{self.key(base_url, endpoint, params)}.json'
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+def current_fiscal_year(today=None):
+    """
+    This function returns the federal fiscal year in progress, which starts on October 1st.
+    Input: date (optional, defaults to today)
+    Output: fiscal year (int)
+    """
+    today = today or date.today()
+    return today.year + 1 if today.month >= 10 else today.year
+
+async def fetch_json(session, semaphore, base_url, endpoint, params, cache=None, retries=5, backoff=1.0, refresh=False):
+    """
+    This function requests one endpoint, retrying rate-limited and failed requests with exponential backoff.
+    Input: aiohttp session, semaphore, base url, endpoint, query parameters, ResponseCache (optional),
+           number of retries, base backoff in seconds, whether to skip the cached response and fetch it again
+    Output: decoded JSON (dict)
+    """
+    if cache is not None and not refresh:
+        data = cache.get(base_url, endpoint, params)
+        if data is not None:
+            return data
+
+    for attempt in range(retries + 1):
+        try:
+            async with semaphore:
+                async with session.get(f'{base_url}{endpoint}', params=params) as resp:
+                    if resp.status in RETRY_STATUS and attempt < retries:
+                        retry_after = resp.headers.get('Retry-After', '')
+                        delay = float(retry_after) if retry_after.isdigit() else backoff * 2 ** attempt
+                    else:
+                        resp.raise_for_status()
+                        data = await resp.json(content_type=None)
+                        break
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+        # Sleep outside the semaphore so waiting requests don't hold a connection slot
+        await asyncio.sleep(delay + random.uniform(0, backoff))
+
+    if cache is not None:
+        cache.put(base_url, endpoint, params, data)
+    return data
+
+def to_frame(data, mode, year):
+    """
+    This function converts one API response to a dataframe.
+    Input: decoded JSON (dict), mode, fiscal year
+    Output: pd.DataFrame
+    """
+    if mode == 'historical':
+        return pd.DataFrame([data])
+    df = pd.DataFrame(data['results'])
+    df.insert(loc = 0,column = 'fiscal_year',value = year)
+    return df
+
+async def fetch_all(agencies, mode='historical', years=YEARS, base_url=BASE_URL, concurrency=11,
+                    retries=5, backoff=1.0, cache_dir=CACHE_DIR, timeout=60, refresh=None):
+    """
+    This function downloads data for every agency and fiscal year over one shared session.
+    Input: dict of agency name -> toptier code, mode, fiscal years, base url, max requests in flight,
+           number of retries, base backoff in seconds, cache folder (None to disable), request timeout in seconds,
+           fiscal years to fetch again even if cached (defaults to the current fiscal year)
+    Output: pd.DataFrame with one Agency column added
+    """
+    if mode not in ENDPOINTS:
+        raise ValueError(f'Unknown mode {mode}, expected one of {list(ENDPOINTS)}')
+
+    cache = ResponseCache(cache_dir) if cache_dir is not None else None
+    refresh = {current_fiscal_year()} if refresh is None else set(refresh)
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        async def one(agency, code, year):
+            data = await fetch_json(session, semaphore, base_url, ENDPOINTS[mode].format(code),
+                                    {'fiscal_year': year}, cache, retries, backoff, year in refresh)
+            df = to_frame(data, mode, year)
+            df.insert(loc = 1,column = 'Agency',value = agency)
+            return df
+
+        jobs = [one(agency, code, year) for agency, code in agencies.items() for year in years]
+        results = await asyncio.gather(*jobs)
+
+    full = pd.concat(results, ignore_index=True)
+
+    if mode == 'historical':
+        full = full.rename(columns={"fiscal_year":"Fiscal Year","obligations":"Obligations"}) # Change column names
+    elif mode == 'category':
+        full = full.rename(columns={"name": "Subagency","fiscal_year":"Fiscal Year","total_obligations":"Obligations"}) # Rename columns
+    full['Fiscal Year']=full['Fiscal Year'].astype(str) # Redefine year as string
+
+    return full
+
+def fetch(agencies=codes, mode='historical', **kwargs):
+    """
+    This function runs fetch_all from synchronous code.
+    Input: same as fetch_all
+    Output: pd.DataFrame
+    """
+    return asyncio.run(fetch_all(agencies, mode, **kwargs))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download agency spending data from USAspending.')
+    parser.add_argument('--mode', choices=list(ENDPOINTS), default='historical')
+    parser.add_argument('--out', default=REPO / 'Clean Data' / 'Plot Data' / 'compare_all_spending.csv', help='CSV file to write')
+    parser.add_argument('--base-url', default=BASE_URL, help='API root, e.g. a local stub server')
+    parser.add_argument('--concurrency', type=int, default=11, help='max requests in flight')
+    parser.add_argument('--retries', type=int, default=5, help='retries for 429 and 5xx responses')
+    parser.add_argument('--start', type=int, default=YEARS.start, help='first fiscal year')
+    parser.add_argument('--end', type=int, default=YEARS.stop - 1, help='last fiscal year')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='folder for cached responses')
+    parser.add_argument('--no-cache', action='store_true', help='always call the API')
+    parser.add_argument('--refresh', type=int, nargs='*', help='fiscal years to fetch again even if cached (default: the current fiscal year, whose numbers still change)')
+    args = parser.parse_args()
+
+    df = fetch(codes, args.mode, years=range(args.start, args.end + 1), base_url=args.base_url,
+               concurrency=args.concurrency, retries=args.retries,
+               cache_dir=None if args.no_cache else args.cache_dir, refresh=args.refresh)
+    if args.mode == 'historical':
+        df = df[['Fiscal Year','Agency','Obligations']]
+    df.to_csv(args.out, index=False)
@@ -0,0 +1,249 @@
+"""
+Geocode the place of performance of service contracts.
+
+Addresses are normalized to a "CITY, ST 12345" key so the same city/state/ZIP5 is only ever resolved once, across
+all fiscal years. Results are kept in a SQLite cache that is committed as it goes, so an interrupted run resumes
+where it stopped. Most addresses are resolved offline from a ZIP5 centroid table; only the rest go to an online
+geocoder, which is pluggable (Nominatim through geopy by default).
+
+The centroid table is built once from the Census Gazetteer ZCTA file:
+    python py/geocode.py --centroids 2023_Gaz_zcta_national.txt
+
+Usage: python py/geocode.py FY2022.csv [FY2023.csv ...] [--out FILE] [--cache FILE] [--offline]
+"""
+import argparse
+import re
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from agencies import agency_code
+
+REPO = Path(__file__).resolve().parent.parent
+CACHE_PATH = REPO / 'Clean Data' / 'address_coordinates.sqlite'
+CENTROID_PATH = REPO / 'Clean Data' / 'zip5_centroids.csv'
+OUT_PATH = REPO / 'Clean Data' / 'data_coordinates.csv'
+
+CITY = 'primary_place_of_performance_city_name'
+STATE = 'primary_place_of_performance_state_code'
+ZIP = 'primary_place_of_performance_zip_4'
+
+# Columns kept for each contract on the map
+KEEP_COLS = ['contract_award_unique_key',
+             'total_obligated_amount',
+             'awarding_sub_agency_name',
+             'awarding_office_name',
+             'recipient_name',
+             'product_or_service_code',
+             'product_or_service_code_description',
+             'naics_description']
+
+# Manually edit abbreviations in addresses based on a manual inspection
+REPLACEMENTS = [(r'\bAFB\b', 'AIR FORCE BASE'),
+                (r'\bM C B H KANEOHE BAY\b', 'MARINE CORPS BASE HAWAII'),
+                (r'\bJBSA\b', 'JOINT BASE SAN ANTONIO'),
+                (r'\bFT\b', 'FORT'),
+                (r'\bJBPHH\b', 'JOINT BASE PEARL HARBOR-HICKAM')]
+
+#### Functions
+
+def zip5(zips):
+    """
+    This function turns ZIP+4 values (read as numbers or text) into five-digit ZIP strings.
+    Input: pd.Series
+    Output: pd.Series of strings, NaN where there is no ZIP
+    """
+    digits = zips.astype(str).str.replace(r'\.0$', '', regex=True).str.replace(r'\D', '', regex=True)
+    # ZIP and ZIP+4 stored as numbers lose their leading zeros
+    digits = digits.str.zfill(5).where(digits.str.len() <= 5, digits.str.zfill(9))
+    return digits.str[:5].where(zips.notna() & (digits != '00000'))
+
+def address_keys(df):
+    """
+    This function builds a normalized "CITY, ST 12345" address key for every contract.
+    Input: df with the place of performance city, state and ZIP columns
+    Output: pd.Series of keys, NaN where the city or ZIP is missing
+    """
+    city = df[CITY].astype(str).str.upper().str.replace(r'[^A-Z0-9 \-]', ' ', regex=True)
+    for pattern, repl in REPLACEMENTS:
+        city = city.str.replace(pattern, repl, regex=True)
+    city = city.str.split().str.join(' ')
+    state = df[STATE].astype(str).str.upper().str.strip()
+    keys = city + ', ' + state + ' ' + zip5(df[ZIP])
+    return keys.where(df[CITY].notna() & df[STATE].notna())
+
+def load_centroids(path=CENTROID_PATH):
+    """
+    This function loads the ZIP5 centroid table.
+    Input: path to a CSV with zip5, lat and lon columns
+    Output: dict of zip5 -> (lat, lon), empty if the table has not been built
+    """
+    path = Path(path)
+    if not path.exists():
+        return {}
+    df = pd.read_csv(path, dtype={'zip5': str})
+    return dict(zip(df['zip5'], zip(df['lat'], df['lon'])))
+
+def build_centroids(gazetteer, path=CENTROID_PATH):
+    """
+    This function builds the ZIP5 centroid table from the Census Gazetteer ZCTA file.
+    Input: path to the tab-separated Gazetteer file, output path
+    Output: pd.DataFrame of zip5, lat, lon
+    """
+    df = pd.read_csv(gazetteer, sep='\t', dtype={'GEOID': str})
+    df.columns = df.columns.str.strip()
+    df = df.rename(columns={'GEOID': 'zip5', 'INTPTLAT': 'lat', 'INTPTLONG': 'lon'})[['zip5', 'lat', 'lon']]
+    df = df.round({'lat': 5, 'lon': 5})
+    df.to_csv(path, index=False)
+    return df
+
+class GeocoderUnavailable(Exception):
+    """
+    Raised by a geocoder when an address could not be looked up (timeout, server error, no network), as opposed
+    to not being found. These addresses are not cached, so a later run tries them again.
+    """
+
+class GeocodeCache:
+    """
+    SQLite cache of address key -> coordinates. Addresses that could not be found are stored with empty
+    coordinates so they are not looked up again.
+    """
+
+    def __init__(self, path=CACHE_PATH):
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS addresses (
+                                 address TEXT PRIMARY KEY,
+                                 lat REAL,
+                                 lon REAL,
+                                 source TEXT NOT NULL,
+                                 updated REAL NOT NULL)""")
+        self.conn.commit()
+
+    def missing(self, keys):
+        """Return the keys that are not cached yet, in their original order."""
+        cached = set()
+        keys = list(dict.fromkeys(keys))
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            rows = self.conn.execute(f'SELECT address FROM addresses WHERE address IN ({",".join("?" * len(batch))})', batch)
+            cached.update(r[0] for r in rows)
+        return [k for k in keys if k not in cached]
+
+    def put_many(self, rows, source):
+        """Store (address, lat, lon) rows and commit."""
+        now = time.time()
+        self.conn.executemany('INSERT OR REPLACE INTO addresses VALUES (?, ?, ?, ?, ?)',
+                              [(a, lat, lon, source, now) for a, lat, lon in rows])
+        self.conn.commit()
+
+    def to_frame(self):
+        return pd.read_sql_query('SELECT address, lat, lon FROM addresses', self.conn)
+
+    def close(self):
+        self.conn.close()
+
+class NominatimGeocoder:
+    """
+    Online geocoder backed by OpenStreetMap Nominatim. The geolocator and rate limiter are built once.
+    Any object with a geocode(address) method returning (lat, lon), or None if the address can't be found, and
+    raising GeocoderUnavailable if it can't be looked up, can be used instead.
+    """
+
+    def __init__(self, user_agent='aliakader', min_delay_seconds=2, timeout=5, max_retries=2):
+        from geopy.extra.rate_limiter import RateLimiter
+        from geopy.geocoders import Nominatim
+
+        geolocator = Nominatim(user_agent=user_agent, timeout=timeout)
+        # Errors are raised rather than returned as None, which would look like an address that doesn't exist
+        self._geocode = RateLimiter(geolocator.geocode, min_delay_seconds=min_delay_seconds, max_retries=max_retries,
+                                    error_wait_seconds=max(min_delay_seconds, 5), swallow_exceptions=False)
+
+    def geocode(self, address):
+        from geopy.exc import GeocoderServiceError
+
+        try:
+            location = self._geocode(address)
+        except GeocoderServiceError as err: # Includes timeouts and unreachable servers
+            raise GeocoderUnavailable(str(err)) from err
+        if location is None:
+            return None
+        return location.latitude, location.longitude
+
+def geocode_addresses(keys, cache, centroids=None, geocoder=None, commit_every=20):
+    """
+    This function resolves every address key that is not cached yet: first offline from the ZIP5 centroids,
+    then with the online geocoder for the remainder. Results are committed in small batches. If the geocoder
+    becomes unavailable, what was resolved so far is kept and the rest is left uncached for the next run.
+    Input: address keys, GeocodeCache, dict of zip5 -> (lat, lon), geocoder (None to stay offline), batch size
+    Output: dict with the number of addresses resolved per source and left unresolved
+    """
+    keys = [k for k in keys if isinstance(k, str)]
+    todo = cache.missing(keys)
+    stats = {'cached': len(set(keys)) - len(todo), 'zip5': 0, 'online': 0, 'left': 0}
+
+    if centroids:
+        offline = [(k, *centroids[k[-5:]]) for k in todo if k[-5:] in centroids]
+        cache.put_many(offline, 'zip5')
+        stats['zip5'] = len(offline)
+        todo = [k for k in todo if k[-5:] not in centroids]
+
+    if geocoder is None:
+        stats['left'] = len(todo)
+        return stats
+
+    batch = []
+    for i, key in enumerate(todo):
+        try:
+            coord = geocoder.geocode(key)
+        except GeocoderUnavailable as err:
+            stats['left'] = len(todo) - i
+            print(f'Geocoder unavailable ({err}), {stats["left"]} addresses left for the next run', file=sys.stderr)
+            break
+        batch.append((key, *(coord or (None, None))))
+        stats['online'] += 1
+        if len(batch) >= commit_every:
+            cache.put_many(batch, 'online')
+            batch = []
+    cache.put_many(batch, 'online')
+    return stats
+
+def geocode_contracts(df, cache, centroids=None, geocoder=None):
+    """
+    This function geocodes the place of performance of every contract and joins the coordinates on.
+    Input: df of raw contracts, GeocodeCache, ZIP5 centroids, geocoder (optional)
+    Output: df of contracts with lat and lon columns, contracts that could not be located are dropped
+    """
+    df = df.assign(Address=address_keys(df)).dropna(subset=['Address'])
+    geocode_addresses(df['Address'].unique().tolist(), cache, centroids, geocoder)
+    coords = cache.to_frame().rename(columns={'address': 'Address'})
+    df = df.merge(coords, how='inner', on='Address').dropna(subset=['lat', 'lon'])
+    return df.drop(columns='Address')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Geocode the place of performance of service contracts.')
+    parser.add_argument('files', nargs='*', help='raw fiscal year CSVs')
+    parser.add_argument('--out', default=OUT_PATH, help='CSV of geocoded contracts to write')
+    parser.add_argument('--cache', default=CACHE_PATH, help='SQLite geocoding cache')
+    parser.add_argument('--centroids', metavar='GAZETTEER', help='build the ZIP5 centroid table from a Census Gazetteer ZCTA file')
+    parser.add_argument('--offline', action='store_true', help='only use cached results and ZIP5 centroids')
+    args = parser.parse_args()
+
+    if args.centroids:
+        print(f'Wrote {len(build_centroids(args.centroids))} ZIP5 centroids to {CENTROID_PATH}')
+
+    if args.files:
+        cache = GeocodeCache(args.cache)
+        centroids = load_centroids()
+        geocoder = None if args.offline else NominatimGeocoder()
+        frames = []
+        for path in args.files:
+            raw = pd.read_csv(path, usecols=KEEP_COLS + [CITY, STATE, ZIP], low_memory=False)
+            df = geocode_contracts(raw, cache, centroids, geocoder)
+            df.insert(1, 'fiscal_year', int(re.search(r'FY(\d{4})', Path(path).name).group(1)))
+            df.insert(1, 'agency', agency_code(path))
+            frames.append(df.drop(columns=[CITY, STATE, ZIP]))
+        cache.close()
+        pd.concat(frames, ignore_index=True).to_csv(args.out, index=False)
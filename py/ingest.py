@@ -0,0 +1,102 @@
+"""
+Stream USAspending award archives into the aggregation pipeline without unpacking them.
+
+Bulk award downloads are zip files holding one or more CSV parts per fiscal year. Each member is decompressed
+as a stream and parsed in bounded chunks with only the needed columns, so peak memory does not depend on the
+size of a fiscal year and no extracted CSVs are written to disk. Archives can be local files or URLs (for
+example the bulk download endpoint or a local stand-in for it); URLs are saved to the raw folder as zips.
+
+Usage: python py/ingest.py SOURCE [SOURCE ...] [--raw-dir DIR] [--out-dir DIR] [--workers N] [--bundle]
+"""
+import argparse
+import os
+import shutil
+import zipfile
+from pathlib import Path
+from urllib.parse import urlparse
+
+import pandas as pd
+import requests
+
+#### Functions
+
+def iter_chunks(path, usecols, chunksize=500000):
+    """
+    This function reads a raw fiscal year file as a stream of dataframe chunks. Zip archives are read member by
+    member straight from the archive.
+    Input: path to a .csv or .zip file, columns to keep, rows per chunk
+    Output: generator of pd.DataFrame
+    """
+    path = Path(path)
+    if path.suffix.lower() != '.zip':
+        yield from pd.read_csv(path, usecols=usecols, chunksize=chunksize, low_memory=False)
+        return
+
+    with zipfile.ZipFile(path) as archive:
+        members = sorted(m for m in archive.namelist() if m.lower().endswith('.csv'))
+        if not members:
+            raise ValueError(f'No CSV files found in {path}')
+        for member in members:
+            with archive.open(member) as f:
+                yield from pd.read_csv(f, usecols=usecols, chunksize=chunksize, low_memory=False)
+
+def download(url, raw_dir):
+    """
+    This function streams an archive from a URL into the raw folder. The file only appears under its final name
+    once it is complete.
+    Input: url, raw folder
+    Output: path of the saved archive
+    """
+    raw_dir = Path(raw_dir)
+    raw_dir.mkdir(parents=True, exist_ok=True)
+    dest = raw_dir / Path(urlparse(url).path).name
+    tmp = dest.with_suffix(dest.suffix + '.part')
+    with requests.get(url, stream=True, timeout=60) as resp:
+        resp.raise_for_status()
+        with open(tmp, 'wb') as f:
+            shutil.copyfileobj(resp.raw, f, length=1 << 20)
+    os.replace(tmp, dest)
+    return dest
+
+def ingest(sources, raw_dir):
+    """
+    This function gathers archives into the raw folder, downloading the ones given as URLs.
+    Input: list of file paths or URLs, raw folder
+    Output: list of archive paths
+    """
+    paths = []
+    for source in sources:
+        if urlparse(str(source)).scheme in ('http', 'https'):
+            paths.append(download(source, raw_dir))
+        else:
+            path = Path(source)
+            if path.resolve().parent != Path(raw_dir).resolve():
+                Path(raw_dir).mkdir(parents=True, exist_ok=True)
+                path = Path(shutil.copy2(path, raw_dir))
+            paths.append(path)
+    return paths
+
+if __name__ == '__main__':
+    import aggregate
+
+    parser = argparse.ArgumentParser(description='Ingest zipped award archives and update the Plot Data tables.')
+    parser.add_argument('sources', nargs='+', help='archive files or URLs, named like FY2022_097_...zip')
+    parser.add_argument('--raw-dir', default=aggregate.RAW_DIR, help='folder to keep archives in')
+    parser.add_argument('--out-dir', default=aggregate.OUT_DIR, help='folder to write Plot Data CSVs to')
+    parser.add_argument('--partial-dir', default=aggregate.PARTIAL_DIR, help='folder for per-year aggregates')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--chunksize', type=int, default=500000, help='rows read per chunk')
+    parser.add_argument('--contracts-dir', nargs='?', const=aggregate.CONTRACTS_DIR, help='also write contract rows as Parquet for the query engine')
+    parser.add_argument('--bundle', action='store_true', help='rebuild the app data bundle afterwards')
+    args = parser.parse_args()
+
+    for path in ingest(args.sources, args.raw_dir):
+        print(f'Ingested {path}')
+    tables = aggregate.run(args.raw_dir, args.out_dir, args.partial_dir, args.workers, args.chunksize,
+                           contracts_dir=args.contracts_dir)
+    for agency, agency_tables in tables.items():
+        print(f'Wrote {len(agency_tables)} tables for {aggregate.names[agency]} to {aggregate.partition(args.out_dir, agency)}')
+
+    if args.bundle:
+        from build_bundle import build_bundle
+        print(build_bundle(args.out_dir))
@@ -0,0 +1,65 @@
+"""
+Build the search index behind the app's recipient, office and PSC lookup.
+
+The Plot Data tables only keep the top 10 groups of each fiscal year, so every distinct recipient, awarding office
+and PSC description is indexed here instead, from the per-year aggregates of py/aggregate.py. Names are normalized
+(case, accents and punctuation removed) and stored sorted, so prefix matches are a binary search, together with
+the trigrams of every word for fuzzy matches, stored as numbers, and the per-year totals of every entity. The three
+tables are written to each agency's Plot Data partition and loaded once per process by myenv/search.py.
+
+Usage: run as part of python py/aggregate.py
+"""
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Names are normalized and split into trigrams by the app's own functions, so the index and the search always agree
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'myenv'))
+from search import normalize, trigrams
+
+#### Setup
+
+AMOUNT = 'total_obligated_amount'
+
+# Dimensions that can be searched
+SEARCH_DIMS = ['recipient_name',
+               'awarding_office_name',
+               'product_or_service_code_description']
+
+# Tables written to each agency's Plot Data partition
+SEARCH_TABLES = ['search_names', 'search_trigrams', 'search_totals']
+
+#### Functions
+
+def build_index(partials):
+    """
+    This function builds the search tables of one agency from its per-year aggregates.
+    Input: dict of fiscal year -> dict of dimension -> pd.DataFrame
+    Output: dict of table name -> pd.DataFrame:
+            search_names (id, dimension, name, key) sorted by key,
+            search_trigrams (trigram, id) sorted by trigram,
+            search_totals (id, fiscal_year, total_obligated_amount, count) sorted by id and fiscal year
+    """
+    frames = []
+    for year, dims in partials.items():
+        for col in SEARCH_DIMS:
+            part = dims[col].rename_axis('name').reset_index()
+            part.insert(0, 'dimension', col)
+            part['fiscal_year'] = year
+            frames.append(part)
+    totals = pd.concat(frames, ignore_index=True)
+
+    names = totals[['dimension', 'name']].drop_duplicates().reset_index(drop=True)
+    names['key'] = names['name'].map(normalize)
+    names = names[names['key'] != ''].sort_values(['key', 'dimension', 'name'], ignore_index=True)
+    names.insert(0, 'id', np.arange(len(names), dtype=np.int32))
+
+    totals = totals.merge(names[['id', 'dimension', 'name']], on=['dimension', 'name'])
+    totals = totals[['id', 'fiscal_year', AMOUNT, 'count']].sort_values(['id', 'fiscal_year'], ignore_index=True)
+
+    grams = [(gram, i) for i, key in zip(names['id'], names['key']) for gram in trigrams(key).tolist()]
+    grams = pd.DataFrame(grams, columns=['trigram', 'id']).sort_values(['trigram', 'id'], ignore_index=True)
+
+    return {'search_names': names, 'search_trigrams': grams, 'search_totals': totals}
@@ -0,0 +1,129 @@
+"""
+Measure the cold start of the app and fail when it goes over budget.
+
+Every measurement runs in a fresh Python process, so nothing is cached between them:
+    import        - time to import myenv/dodcontractapp.py, plus a check that no forbidden heavy module was loaded
+    first render  - time for the whole app, and for each interactive tab on its own, to render once with an empty
+                    cache (using Streamlit's AppTest, so no browser or server is needed)
+
+The budget lives in py/startup_budget.json. Results are printed as JSON and the exit code is 1 if any budget
+is exceeded, so this can run in CI.
+
+Usage: python py/startup_budget.py [--budget FILE] [--repeat N] [--out FILE]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+APP_DIR = REPO / 'myenv'
+APP = APP_DIR / 'dodcontractapp.py'
+BUDGET_PATH = Path(__file__).resolve().parent / 'startup_budget.json'
+
+# Arguments each tab function is rendered with
+TABS = {'compare_agencies_tab': "'Department of Defense'",
+        'breakdown_tab': "'Department of Defense'",
+        'search_tab': "'Department of Defense'",
+        'category_tab': "'Department of Defense'",
+        'state_map_tab': "'Department of Defense'"}
+
+IMPORT_SCRIPT = '''
+import json, sys, time
+t = time.perf_counter()
+import dodcontractapp
+seconds = time.perf_counter() - t
+print(json.dumps({'seconds': seconds, 'modules': sorted(sys.modules)}))
+'''
+
+RENDER_SCRIPT = '''
+import json, time
+from streamlit.testing.v1 import AppTest
+t = time.perf_counter()
+at = {loader}
+at.run()
+seconds = time.perf_counter() - t
+print(json.dumps({{'seconds': seconds, 'errors': [e.message for e in at.exception]}}))
+'''
+
+#### Functions
+
+def run_fresh(script):
+    """
+    This function runs a measurement script in a new Python process with the app folder on the path.
+    Input: script source (string)
+    Output: dict printed by the script as its last line of output
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(APP_DIR), os.environ.get('PYTHONPATH', '')]))
+    proc = subprocess.run([sys.executable, '-c', script], cwd=APP_DIR, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def measure_import(repeat):
+    """
+    This function times the import of the app module.
+    Input: number of runs
+    Output: median seconds, list of modules loaded by the import
+    """
+    runs = [run_fresh(IMPORT_SCRIPT) for _ in range(repeat)]
+    return statistics.median(r['seconds'] for r in runs), runs[-1]['modules']
+
+def measure_render(target, repeat):
+    """
+    This function times the first render of the whole app or of one tab.
+    Input: 'app' or the name of a tab function, number of runs
+    Output: median seconds, list of errors raised while rendering
+    """
+    if target == 'app':
+        loader = f'AppTest.from_file({str(APP)!r}, default_timeout=120)'
+    else:
+        source = f'import dodcontractapp as app\napp.{target}({TABS[target]})\n'
+        loader = f'AppTest.from_string({source!r}, default_timeout=120)'
+    runs = [run_fresh(RENDER_SCRIPT.format(loader=loader)) for _ in range(repeat)]
+    return statistics.median(r['seconds'] for r in runs), runs[-1]['errors']
+
+def check(budget, repeat=3):
+    """
+    This function measures every start-up step and compares it with the budget.
+    Input: budget (dict), number of runs per measurement
+    Output: results (dict), list of budget violations
+    """
+    failures = []
+    import_s, modules = measure_import(repeat)
+    loaded = sorted(m for m in budget.get('forbidden_modules', []) if m in modules)
+    results = {'import_s': round(import_s, 3), 'forbidden_loaded': loaded, 'first_render_s': {}}
+    if import_s > budget['import_s']:
+        failures.append(f'import took {import_s:.2f}s, budget {budget["import_s"]}s')
+    if loaded:
+        failures.append(f'import loaded forbidden modules: {", ".join(loaded)}')
+
+    for target, limit in budget['first_render_s'].items():
+        seconds, errors = measure_render(target, repeat)
+        results['first_render_s'][target] = round(seconds, 3)
+        if errors:
+            failures.append(f'{target} raised: {errors[0]}')
+        if seconds > limit:
+            failures.append(f'{target} took {seconds:.2f}s to render, budget {limit}s')
+    return results, failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check app cold start against a time budget.')
+    parser.add_argument('--budget', default=BUDGET_PATH, help='JSON budget file')
+    parser.add_argument('--repeat', type=int, default=3, help='fresh-process runs per measurement (median is used)')
+    parser.add_argument('--out', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    with open(args.budget) as f:
+        budget = json.load(f)
+    results, failures = check(budget, args.repeat)
+    results['failures'] = failures
+
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,71 @@
+"""
+Build the Plot Data tables and the app data bundle of a civilian agency from synthetic raw files.
+
+Usage: python -m pytest tests
+"""
+import shutil
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO / 'py'))
+sys.path.insert(0, str(REPO / 'myenv'))
+
+import aggregate
+import benchmark
+from agencies import codes, partition
+from build_bundle import build_bundle
+
+AGENCY = codes['Department of Energy']
+
+#### Functions
+
+def write_raw(raw_dir, agency, years, claimant=True):
+    """
+    This function writes small synthetic raw fiscal year files for one agency.
+    Input: raw folder, agency code, fiscal years, whether contracts have a DoD claimant program
+    Output: None
+    """
+    rng = np.random.default_rng(0)
+    states = pd.read_csv(benchmark.PLOT_DIR / 'states.csv')['State'].tolist()
+    raw_dir.mkdir(parents=True, exist_ok=True)
+    for year in years:
+        df = benchmark.synthetic_year(rng, 2000, 1, states)
+        if not claimant:
+            df['dod_claimant_program_description'] = np.nan
+        df.to_csv(raw_dir / f'FY{year}_{agency}_synthetic.csv', index=False)
+
+def test_civilian_agency(tmp_path):
+    """
+    Civilian contracts leave the DoD claimant program blank, so that dimension has no groups. The agency still gets
+    every table, with an empty claimant program breakdown, and is published in the bundle next to DoD.
+    """
+    raw_dir, plot_dir = tmp_path / 'raw', tmp_path / 'plot'
+    write_raw(raw_dir, codes['Department of Defense'], [2021, 2022])
+    write_raw(raw_dir, AGENCY, [2021, 2022], claimant=False)
+
+    tables = aggregate.run(raw_dir, plot_dir, tmp_path / 'partials', workers=1, contracts_dir=tmp_path / 'contracts')
+    assert set(tables) == {codes['Department of Defense'], AGENCY}
+    assert set(tables[AGENCY]) == set(aggregate.table_names())
+    assert tables[AGENCY]['dod_claimant_program_description'].empty
+    assert set(tables[AGENCY]['recipient_name']['fiscal_year']) == {2021, 2022}
+
+    # A rerun with nothing new rebuilds from the stored partials
+    (partition(plot_dir, AGENCY) / 'recipient_name.csv').unlink()
+    tables = aggregate.run(raw_dir, plot_dir, tmp_path / 'partials', workers=1, contracts_dir=tmp_path / 'contracts')
+    assert set(tables) == {AGENCY}
+    assert tables[AGENCY]['dod_claimant_program_description'].empty
+
+    for name in benchmark.STATIC_TABLES:
+        shutil.copy2(benchmark.PLOT_DIR / f'{name}.csv', plot_dir)
+    build_bundle(plot_dir, tmp_path / 'bundle')
+
+    import databundle
+    databundle.BUNDLE_ROOT = tmp_path / 'bundle'
+    databundle.invalidate()
+    assert 'Department of Energy' in databundle.read_table('agencies')['agency'].tolist()
+    assert databundle.read_table(f'agency={AGENCY}/dod_claimant_program_description').empty
+    assert len(databundle.read_table(f'agency={AGENCY}/recipient_name')) > 0